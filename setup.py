@@ -19,6 +19,9 @@ setup(
         'pydantic>=0.18',
         'arrow>=0.12.1,<1'
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     zip_safe=False,
     classifiers=[
         'Development Status :: 3 - Alpha',
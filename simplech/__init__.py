@@ -6,3 +6,5 @@ from .deltagen import DeltaGenerator
 from .simplech import ClickHouse, AsyncClickHouse, BaseClickHouse, bytes_decoder, json_decoder
 
 
+
+from .retry import RetryPolicy, ClickHouseHTTPError
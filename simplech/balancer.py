@@ -0,0 +1,98 @@
+from itertools import count
+from time import monotonic
+from .log import logger
+
+
+LATENCY = 'latency'
+ROUND_ROBIN = 'round_robin'
+
+
+def parse_hosts(hosts, default_port=8123):
+    """
+    Returns list of `host:port` from list or comma separated string of `host[:port]`
+    """
+    if isinstance(hosts, str):
+        hosts = hosts.split(',')
+    result = []
+    for item in hosts:
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, port = item.rpartition(':')
+        if not sep or name.endswith(':') or not port.isdigit():
+            # no port or bare ipv6 address
+            name, port = item, default_port
+        result.append(f'{name}:{port}')
+    return result
+
+
+class Host:
+
+    __slots__ = ('base_url', 'latency', 'down_until')
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        # moving average of response time, seconds
+        self.latency = None
+        self.down_until = 0
+
+    def __repr__(self):
+        return f'<Host {self.base_url} latency={self.latency}>'
+
+
+class HostBalancer:
+    """
+    Chooses replica for every request.
+
+    strategy: `round_robin` - hosts in turn, `latency` - of two next hosts in turn
+        the one with less average response time (power of two choices), so load
+        is spread, but slow replicas get less requests
+    down_time: seconds failed host is excluded from balancing
+    decay: weight of last measurement in average response time
+    """
+
+    def __init__(self, hosts, strategy=LATENCY, down_time=30, decay=0.3):
+        if strategy not in (LATENCY, ROUND_ROBIN):
+            raise ValueError(f'Unknown balancing strategy {strategy}')
+        if not hosts:
+            raise ValueError('At least one host is required')
+        self.hosts = [Host(h) for h in hosts]
+        self.strategy = strategy
+        self.down_time = down_time
+        self.decay = decay
+        self._counter = count()
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def candidates(self):
+        """
+        Returns hosts in order they should be tried: chosen one, other available
+        hosts, then hosts marked down (the ones to be back sooner first)
+        """
+        if len(self.hosts) == 1:
+            return self.hosts
+        now = monotonic()
+        up = [h for h in self.hosts if h.down_until <= now]
+        down = sorted((h for h in self.hosts if h.down_until > now), key=lambda h: h.down_until)
+        if len(up) > 1:
+            i = next(self._counter) % len(up)
+            up = up[i:] + up[:i]
+            if self.strategy == LATENCY and (up[1].latency or 0) < (up[0].latency or 0):
+                up[0], up[1] = up[1], up[0]
+        return up + down
+
+    def report(self, host, elapsed):
+        if host.latency is None:
+            host.latency = elapsed
+        else:
+            host.latency += self.decay * (elapsed - host.latency)
+        host.down_until = 0
+
+    def mark_down(self, host):
+        if len(self.hosts) == 1:
+            return
+        now = monotonic()
+        if host.down_until <= now:
+            logger.warning('host %s marked down for %s s', host.base_url, self.down_time)
+        host.down_until = now + self.down_time
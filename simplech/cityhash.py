@@ -0,0 +1,165 @@
+"""
+CityHash64 v1.0.2, the version used by ClickHouse `cityHash64` function
+"""
+import struct
+
+MASK = 0xFFFFFFFFFFFFFFFF
+
+K0 = 0xc3a5c85c97cb3127
+K1 = 0xb492b66fbe98f273
+K2 = 0x9ae16a3b2f90404f
+K3 = 0xc949d7c7509e6557
+KMUL = 0x9ddfea08eb382d69
+# ClickHouse salts integers before hashing
+INT_HASH_SALT = 0x4CF2D2BAAE6DA887
+
+_u64 = struct.Struct('<Q').unpack_from
+_u32 = struct.Struct('<I').unpack_from
+
+
+def fetch64(s, pos):
+    return _u64(s, pos)[0]
+
+
+def fetch32(s, pos):
+    return _u32(s, pos)[0]
+
+
+def rotate(val, shift):
+    if shift == 0:
+        return val
+    return ((val >> shift) | (val << (64 - shift))) & MASK
+
+
+def shift_mix(val):
+    return val ^ (val >> 47)
+
+
+def hash128to64(low, high):
+    a = ((low ^ high) * KMUL) & MASK
+    a ^= a >> 47
+    b = ((high ^ a) * KMUL) & MASK
+    b ^= b >> 47
+    return (b * KMUL) & MASK
+
+
+def hash_len16(u, v):
+    return hash128to64(u, v)
+
+
+def hash_len0to16(s, length):
+    if length > 8:
+        a = fetch64(s, 0)
+        b = fetch64(s, length - 8)
+        return hash_len16(a, rotate((b + length) & MASK, length)) ^ b
+    if length >= 4:
+        a = fetch32(s, 0)
+        return hash_len16((length + (a << 3)) & MASK, fetch32(s, length - 4))
+    if length > 0:
+        a = s[0]
+        b = s[length >> 1]
+        c = s[length - 1]
+        y = (a + (b << 8)) & 0xFFFFFFFF
+        z = (length + (c << 2)) & 0xFFFFFFFF
+        return (shift_mix(((y * K2) ^ (z * K3)) & MASK) * K2) & MASK
+    return K2
+
+
+def hash_len17to32(s, length):
+    a = (fetch64(s, 0) * K1) & MASK
+    b = fetch64(s, 8)
+    c = (fetch64(s, length - 8) * K2) & MASK
+    d = (fetch64(s, length - 16) * K0) & MASK
+    return hash_len16(
+        (rotate((a - b) & MASK, 43) + rotate(c, 30) + d) & MASK,
+        (a + rotate(b ^ K3, 20) - c + length) & MASK)
+
+
+def weak_hash_len32_with_seeds(s, pos, a, b):
+    w = fetch64(s, pos)
+    x = fetch64(s, pos + 8)
+    y = fetch64(s, pos + 16)
+    z = fetch64(s, pos + 24)
+    a = (a + w) & MASK
+    b = rotate((b + a + z) & MASK, 21)
+    c = a
+    a = (a + x + y) & MASK
+    b = (b + rotate(a, 44)) & MASK
+    return (a + z) & MASK, (b + c) & MASK
+
+
+def hash_len33to64(s, length):
+    z = fetch64(s, 24)
+    a = (fetch64(s, 0) + (length + fetch64(s, length - 16)) * K0) & MASK
+    b = rotate((a + z) & MASK, 52)
+    c = rotate(a, 37)
+    a = (a + fetch64(s, 8)) & MASK
+    c = (c + rotate(a, 7)) & MASK
+    a = (a + fetch64(s, 16)) & MASK
+    vf = (a + z) & MASK
+    vs = (b + rotate(a, 31) + c) & MASK
+    a = (fetch64(s, 16) + fetch64(s, length - 32)) & MASK
+    z = fetch64(s, length - 8)
+    b = rotate((a + z) & MASK, 52)
+    c = rotate(a, 37)
+    a = (a + fetch64(s, length - 24)) & MASK
+    c = (c + rotate(a, 7)) & MASK
+    a = (a + fetch64(s, length - 16)) & MASK
+    wf = (a + z) & MASK
+    ws = (b + rotate(a, 31) + c) & MASK
+    r = shift_mix(((vf + ws) * K2 + (wf + vs) * K0) & MASK)
+    return (shift_mix((r * K0 + vs) & MASK) * K2) & MASK
+
+
+def city_hash64(s):
+    """
+    CityHash64 of bytes
+    """
+    length = len(s)
+    if length <= 16:
+        return hash_len0to16(s, length)
+    if length <= 32:
+        return hash_len17to32(s, length)
+    if length <= 64:
+        return hash_len33to64(s, length)
+
+    x = fetch64(s, 0)
+    y = fetch64(s, length - 16) ^ K1
+    z = fetch64(s, length - 56) ^ K0
+    v = weak_hash_len32_with_seeds(s, length - 64, length, y)
+    w = weak_hash_len32_with_seeds(s, length - 32, (length * K1) & MASK, K0)
+    z = (z + shift_mix(v[1]) * K1) & MASK
+    x = (rotate((z + x) & MASK, 39) * K1) & MASK
+    y = (rotate(y, 33) * K1) & MASK
+
+    pos = 0
+    left = (length - 1) & ~63
+    while True:
+        x = (rotate((x + y + v[0] + fetch64(s, pos + 16)) & MASK, 37) * K1) & MASK
+        y = (rotate((y + v[1] + fetch64(s, pos + 48)) & MASK, 42) * K1) & MASK
+        x ^= w[1]
+        y ^= v[0]
+        z = rotate(z ^ w[0], 33)
+        v = weak_hash_len32_with_seeds(s, pos, (v[1] * K1) & MASK, (x + w[0]) & MASK)
+        w = weak_hash_len32_with_seeds(s, pos + 32, (z + w[1]) & MASK, y)
+        z, x = x, z
+        pos += 64
+        left -= 64
+        if not left:
+            break
+    return hash_len16(
+        (hash_len16(v[0], w[0]) + shift_mix(y) * K1 + z) & MASK,
+        (hash_len16(v[1], w[1]) + x) & MASK)
+
+
+def int_hash64(x):
+    """
+    ClickHouse `intHash64`, also used by `cityHash64` for numbers
+    """
+    x = (x & MASK) ^ INT_HASH_SALT
+    x ^= x >> 33
+    x = (x * 0xff51afd7ed558ccd) & MASK
+    x ^= x >> 33
+    x = (x * 0xc4ceb9fe1a85ec53) & MASK
+    x ^= x >> 33
+    return x
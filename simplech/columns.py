@@ -0,0 +1,113 @@
+from .rowbinary import RowBinaryDecoder, INCOMPLETE, base_type, column_reader, fixed_format
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Numpy dtypes of raw values and final dtypes of columns
+NUMPY_TYPES = {
+    'Int8': ('i1', None),
+    'UInt8': ('u1', None),
+    'Int16': ('i2', None),
+    'UInt16': ('u2', None),
+    'Int32': ('i4', None),
+    'UInt32': ('u4', None),
+    'Int64': ('i8', None),
+    'UInt64': ('u8', None),
+    'Float32': ('f4', None),
+    'Float64': ('f8', None),
+    'Bool': ('u1', 'bool'),
+    'Date': ('u2', 'datetime64[D]'),
+    'Date32': ('i4', 'datetime64[D]'),
+    'DateTime': ('u4', 'datetime64[s]'),
+}
+
+
+class ColumnBuilder:
+    """
+    Growable preallocated numpy array
+    """
+
+    def __init__(self, dtype, final_dtype=None, capacity=1024):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.final_dtype = final_dtype
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, values):
+        end = self.size + len(values)
+        if end > len(self.data):
+            capacity = len(self.data) * 2
+            while capacity < end:
+                capacity *= 2
+            data = np.empty(capacity, dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:end] = values
+        self.size = end
+
+    def result(self):
+        res = self.data[:self.size]
+        if self.final_dtype:
+            res = res.astype(self.final_dtype)
+        return res
+
+
+class ColumnarDecoder(RowBinaryDecoder):
+    """
+    Decodes RowBinaryWithNamesAndTypes stream directly into numpy arrays.
+    If all columns are fixed width, chunks are converted by numpy without
+    touching separate values. Otherwise rows are decoded and transposed by chunks.
+    """
+
+    def __init__(self, columns=None):
+        if np is None:
+            raise ImportError('numpy is required for columnar select')
+        super().__init__(columns=columns)
+
+    def _setup(self, names, types):
+        super()._setup(names, types)
+        self._readers = [column_reader(t, raw=True) for t in types]
+        self._builders = []
+        fields = []
+        for i, ctype in enumerate(types):
+            ctype = base_type(ctype)
+            dtype, final_dtype = NUMPY_TYPES.get(ctype, ('O', None))
+            self._builders.append(ColumnBuilder(dtype, final_dtype))
+            if fixed_format(ctype):
+                fields.append((f'f{i}', '<' + dtype))
+        self._dtype = np.dtype(fields) if self._row_struct else None
+
+    def feed(self, chunk):
+        data = self._tail + chunk if self._tail else chunk
+        pos = 0
+        if self.names is None:
+            try:
+                pos = self._read_header(data, pos)
+            except INCOMPLETE:
+                self._tail = data
+                return
+        if self._dtype is not None:
+            count = (len(data) - pos) // self._dtype.itemsize
+            if count:
+                arr = np.frombuffer(data, dtype=self._dtype, count=count, offset=pos)
+                for i, builder in enumerate(self._builders):
+                    builder.extend(arr[f'f{i}'])
+                pos += count * self._dtype.itemsize
+        else:
+            rows = []
+            pos = self._read_rows(data, pos, rows)
+            if rows:
+                for builder, values in zip(self._builders, zip(*rows)):
+                    builder.extend(values)
+        self._tail = data[pos:]
+
+    def result(self):
+        self.close()
+        if self.names is None:
+            return {}
+        return {name: builder.result() for name, builder in zip(self.names, self._builders)}
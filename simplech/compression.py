@@ -0,0 +1,151 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+
+GZIP = 'gzip'
+DEFLATE = 'deflate'
+ZSTD = 'zstd'
+LZ4 = 'lz4'
+
+
+class ZlibCompressor:
+    """
+    Streaming gzip / deflate (zlib) compressor
+    """
+
+    def __init__(self, wbits, level=3):
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+
+class ZstdCompressor:
+
+    def __init__(self, level=3):
+        self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+
+class Lz4Compressor:
+
+    def __init__(self):
+        self._obj = lz4frame.LZ4FrameCompressor()
+        self._header = self._obj.begin()
+
+    def compress(self, data):
+        header, self._header = self._header, b''
+        return header + self._obj.compress(data)
+
+    def flush(self):
+        header, self._header = self._header, b''
+        return header + self._obj.flush()
+
+
+COMPRESSORS = {
+    GZIP: lambda: ZlibCompressor(31),
+    DEFLATE: lambda: ZlibCompressor(15),
+}
+if zstandard:
+    COMPRESSORS[ZSTD] = ZstdCompressor
+if lz4frame:
+    COMPRESSORS[LZ4] = Lz4Compressor
+
+
+def resolve_method(method):
+    """
+    Returns name of compression method (used as Content-Encoding).
+    `True` means best available: zstd, lz4 or gzip
+    """
+    if not method:
+        return None
+    if method is True:
+        for name in (ZSTD, LZ4, GZIP):
+            if name in COMPRESSORS:
+                return name
+    if method not in COMPRESSORS:
+        raise ValueError(f'Compression method {method} is not available')
+    return method
+
+
+def get_compressor(method):
+    return COMPRESSORS[resolve_method(method)]()
+
+
+DECOMPRESSORS = {
+    # 32 + 15: detect gzip or zlib header automatically
+    GZIP: lambda: zlib.decompressobj(47),
+    DEFLATE: lambda: zlib.decompressobj(47),
+}
+if zstandard:
+    DECOMPRESSORS[ZSTD] = lambda: zstandard.ZstdDecompressor().decompressobj()
+if lz4frame:
+    DECOMPRESSORS[LZ4] = lz4frame.LZ4FrameDecompressor
+
+
+class DecompressingReader:
+    """
+    Wraps http.client response with compressed body. Data is decompressed
+    by chunks while it is read, `read` and `readline` return decompressed data.
+    Other attributes are proxied to original response.
+    """
+
+    def __init__(self, response, method, chunk_size=65536):
+        self.response = response
+        self.chunk_size = chunk_size
+        self._obj = DECOMPRESSORS[method]()
+        self._buf = b''
+        self._pos = 0
+        self._eof = False
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def _fill(self):
+        chunk = self.response.read(self.chunk_size)
+        if chunk:
+            data = self._obj.decompress(chunk)
+        else:
+            self._eof = True
+            data = self._obj.flush() if hasattr(self._obj, 'flush') else b''
+        if data:
+            self._buf = self._buf[self._pos:] + data
+            self._pos = 0
+
+    def read(self, amt=None):
+        if amt is None:
+            while not self._eof:
+                self._fill()
+            amt = len(self._buf) - self._pos
+        while len(self._buf) - self._pos < amt and not self._eof:
+            self._fill()
+        end = self._pos + amt
+        data = self._buf[self._pos:end]
+        self._pos = min(end, len(self._buf))
+        return data
+
+    def readline(self):
+        while True:
+            idx = self._buf.find(b'\n', self._pos)
+            if idx >= 0:
+                return self.read(idx + 1 - self._pos)
+            if self._eof:
+                return self.read(len(self._buf) - self._pos)
+            self._fill()
@@ -1,17 +1,94 @@
+import asyncio
+import datetime
+import threading
+from queue import Queue, Full
+from concurrent.futures import ThreadPoolExecutor
 import ujson
+from .encoder import to_string, to_int, to_float, to_date, to_datetime
+from .external import ExternalTable
+from .rowbinary import type_name
+from .sharding import tuple_hasher
 from .log import logger
 
+
+# Diff modes
+MEMORY = 'memory'
+SORTED = 'sorted'
+SERVER = 'server'
+MODES = (MEMORY, SORTED, SERVER)
+
+# Partitions of date range
+DAY = 'day'
+MONTH = 'month'
+PARTITION_KEY_LENGTH = {DAY: 10, MONTH: 7}
+
+NEW_DATA_TABLE = 'delta_new'
+REMOVED_KEYS_TABLE = 'delta_removed'
+DELTA_COLUMN = '__delta'
+KEY_COLUMN = '__key'
+
+KEY_CONVERTERS = {
+    'String': to_string,
+    'Date': to_date,
+    'DateTime': to_datetime,
+    'Float32': to_float,
+    'Float64': to_float,
+}
+
+
+def key_function(dims):
+    """
+    Function row -> tuple of dimensions values, ordered the same way as ClickHouse orders them
+    """
+    converters = []
+    for name, ctype in dims.items():
+        ctype = type_name(ctype)
+        convert = KEY_CONVERTERS.get(ctype)
+        if not convert:
+            convert = to_int if ctype.startswith(('Int', 'UInt')) else to_string
+        converters.append((name, convert))
+    return lambda row: tuple([convert(row.get(name)) for name, convert in converters])
+
+
+def partition_ranges(d1, d2, partition=MONTH):
+    """
+    Splits date range to list of (first date, last date) of days or months
+    """
+    if partition not in PARTITION_KEY_LENGTH:
+        raise ValueError(f'Unknown partition {partition}')
+    start = datetime.date.fromisoformat(to_date(d1)[:10])
+    end = datetime.date.fromisoformat(to_date(d2)[:10])
+    ranges = []
+    while start <= end:
+        stop = start
+        if partition == MONTH:
+            stop = (start.replace(day=1) + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+        stop = min(stop, end)
+        ranges.append((start.isoformat(), stop.isoformat()))
+        start = stop + datetime.timedelta(days=1)
+    return ranges
+
+
 class DeltaRunner:
-    def __init__(self, ch, discovery, **kwargs):
+    def __init__(self, ch, discovery, partition=None, concurrency=4, **kwargs):
         self.kwargs = kwargs
         self.ch = ch
         self.discovery = discovery
+        self.partition = partition
+        self.concurrency = concurrency
 
-    def __enter__(self):
+    def _generator(self):
+        if self.partition:
+            return PartitionedDeltaGenerator(
+                ch=self.ch, discovery=self.discovery, partition=self.partition,
+                concurrency=self.concurrency, **self.kwargs)
         return DeltaGenerator(ch=self.ch, discovery=self.discovery, **self.kwargs)
 
+    def __enter__(self):
+        return self._generator()
+
     async def __aenter__(self):
-        return DeltaGenerator(ch=self.ch, discovery=self.discovery, **self.kwargs)
+        return self._generator()
 
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -26,15 +103,109 @@ class DeltaRunner:
 
 
 
-class DeltaGenerator:
-    def __init__(self, discovery, ch, d1, d2, data, dimensions_criteria=None):
+class DeltaWriter:
+    """
+    Writing of correction rows to table while diff is computed
+    """
+
+    def apply(self, batch_size=1000):
+        """
+        Rows are encoded by batches into dedicated buffer of table, full buffers are
+        inserted by background thread. Next full buffer waits for previous insert,
+        so at most one insert is in flight. Partitioned buffer inserts every full
+        partition separately. Returns stat
+        """
+        ch = self.ch
+        table = self.disco.table
+        executor = ThreadPoolExecutor(1)
+        inflight = None
+        buff = ch._create_buffer(table)
+        # aggregating and partitioned buffers take rows and encode them on flush
+        encode = None if buff.by_rows else self.disco.encoder
+        batch = []
+
+        def take(last):
+            nonlocal buff
+            if buff.partitioned:
+                return buff.pop_parts(due_only=not last)
+            if buff.full or (last and len(buff)):
+                full, buff = buff, ch._create_buffer(table)
+                return [full]
+            return []
+
+        def write(batch, last=False):
+            nonlocal inflight
+            if batch:
+                buff.append_many(batch)
+            for part in take(last):
+                part.prepare()
+                if inflight:
+                    inflight.result()
+                inflight = executor.submit(ch._flush, table, part)
+
+        try:
+            for row in self:
+                batch.append(encode(row) if encode else row)
+                if len(batch) >= batch_size:
+                    write(batch)
+                    batch = []
+            write(batch, last=True)
+            if inflight:
+                inflight.result()
+        finally:
+            executor.shutdown()
+            buff.close()
+        return self.stat
+
+    async def apply_async(self, batch_size=1000):
+        """
+        Rows are encoded by batches and pushed to buffer of table, which is inserted
+        in background. Waits for inserts in flight to fit client limits (`drain`). Returns stat
+        """
+        ch = self.ch
+        table = self.disco.table
+        encode = None if table in ch._row_tables else self.disco.encoder
+        batch = []
+        async for row in self:
+            batch.append(encode(row) if encode else row)
+            if len(batch) >= batch_size:
+                ch.push_many(table, batch, jsonDump=False)
+                batch = []
+                await ch.drain()
+        if batch:
+            ch.push_many(table, batch, jsonDump=False)
+        result = ch.flush(table)
+        if result:
+            await result
+        return self.stat
+
+
+class DeltaGenerator(DeltaWriter):
+    def __init__(self, discovery, ch, d1, d2, data, dimensions_criteria=None, mode=MEMORY, hash_keys=False):
         
         """
         Restrictions
         Work only with additionable and substractable metrics.
         do not store calculable values like CTR. 
+
+        mode:
+        `memory` - new data is loaded to dict and compared with rows read from server
+        `sorted` - `data` should be sorted by dimensions (in order of table columns),
+            it is merged with rows read in the same order, in constant memory
+        `server` - new data is sent along with query as external table,
+            server joins it with stored rows and returns only correction rows
+
+        hash_keys: in memory mode rows are keyed by `cityHash64` of dimensions, computed
+            by server for stored rows, which are read as (hash, metrics).
+            Dimensions of removed rows are read by second query
         """
-        
+        if mode not in MODES:
+            raise ValueError(f'Unknown diff mode {mode}')
+        if hash_keys and mode != MEMORY:
+            raise ValueError('Hash keys are supported only in memory mode')
+        self.mode = mode
+        self.hash_keys = hash_keys
+        self.removed_keys = []
         self.data = data
         self.ch = ch
         self.disco = discovery
@@ -56,7 +227,7 @@ class DeltaGenerator:
         return self._stat
 
     def push(self, row):
-        return self.ch.push(self.disco.table, row)
+        return self.ch.push(self.disco.table, self.disco.encoder(row), jsonDump=False)
 
     @staticmethod
     def dim_key(dims, row):
@@ -84,9 +255,7 @@ class DeltaGenerator:
             row[m] = -1 * cls.def_metric(mtype, m, row)
         return row
     
-    def prepare_query(self, dims, metrics):
-
-        # Selecting current Data
+    def prepare_where(self):
         where = [
             f"`{self.disco.date_field}` >= '{self.d1}'",
             f"`{self.disco.date_field}` <= '{self.d2}'"
@@ -95,37 +264,212 @@ class DeltaGenerator:
             for param, val in self.dimensions_criteria.items():
                 val = ujson.dumps(val).replace('"', '\'')
                 where.append(f'`{param}` == {val}')
-        
+        return " AND ".join(where)
+
+    def prepare_query(self, dims, metrics, order=False, condition=None, select_key=None):
+
+        # Selecting current Data
         sfrom = f"`{self.disco.table}`"
-        where = " AND ".join(where)
-        select = ", ".join([f'`{f}`' for f in dims] + [f' sum(`{f}`) `{f}`' for f in metrics])
+        where = self.prepare_where()
+        if condition:
+            where += f" AND {condition}"
+        keys = [f'{select_key} `{KEY_COLUMN}`'] if select_key else [f'`{f}`' for f in dims]
+        select = ", ".join(keys + [f' sum(`{f}`) `{f}`' for f in metrics])
         groupby = ", ".join([f'`{f}`' for f in dims])
 
         q = f"SELECT {select} FROM {sfrom} WHERE {where} GROUP BY {groupby}"
+        if order:
+            q += f" ORDER BY {groupby}"
         return q
-    
+
+    def prepare_delta_query(self, dims, metrics):
+        """
+        Query joining stored rows with new ones from external table,
+        returns correction rows with kind of change in `__delta` column
+        """
+        groupby = ", ".join([f'`{f}`' for f in dims])
+        stored = ", ".join([f'`{f}`' for f in dims] + [f'sum(`{f}`) `__old_{f}`' for f in metrics])
+        stored = f"SELECT {stored}, 1 `__old` FROM `{self.disco.table}` WHERE {self.prepare_where()} GROUP BY {groupby}"
+        # the last row wins as in memory mode
+        new = ", ".join([f'`{f}`' for f in dims] + [f'anyLast(`{f}`) `__new_{f}`' for f in metrics])
+        new = f"SELECT {new}, 1 `__new` FROM {NEW_DATA_TABLE} GROUP BY {groupby}"
+        # absent side of join is filled by zeros
+        select = ", ".join([f'`{f}`' for f in dims] + [f'`__new_{f}` - `__old_{f}` `{f}`' for f in metrics])
+        changed = " + ".join([f'abs(`{f}`)' for f in metrics]) or '0'
+        return (
+            f"SELECT {select}, multiIf(`__old` = 0, 'create', `__new` = 0, 'remove', 'update') `{DELTA_COLUMN}` "
+            f"FROM ({stored}) `__stored` FULL OUTER JOIN ({new}) `__new_data` USING ({groupby}) "
+            f"WHERE `__old` = 0 OR `__new` = 0 OR {changed} > 0 "
+            f"SETTINGS join_use_nulls = 0")
+
+    def prepare_hash_queries(self, dims, metrics, hasher):
+        """
+        Query of (hash, metrics) of stored rows and query of rows by hashes from external table
+        """
+        return (
+            self.prepare_query(dims, metrics, select_key=hasher.expression),
+            self.prepare_query(dims, metrics, condition=f'{hasher.expression} IN {REMOVED_KEYS_TABLE}'))
+
+    def removed_keys_table(self):
+        return ExternalTable(REMOVED_KEYS_TABLE, {'key': 'UInt64'}, [{'key': key} for key in self.removed_keys])
+
+    def handle_hashed_record(self, row, metrics):
+        key = int(row.pop(KEY_COLUMN))
+        new_row = self.recs_map.pop(key, None)
+        if new_row is not None:
+            return self.updated_row(metrics, new_row, row)
+        self.removed_keys.append(key)
+
+    def iter_hashed(self, dimensions, metrics):
+        hasher = tuple_hasher(dimensions)
+        for row in self.data:
+            self.recs_map[hasher(row)] = row
+        q, removed_q = self.prepare_hash_queries(dimensions, metrics, hasher)
+        for row in self.ch.objects_stream(q):
+            rec = self.handle_hashed_record(row, metrics)
+            if rec:
+                yield rec
+        if self.removed_keys:
+            for row in self.ch.objects_stream(removed_q, external=[self.removed_keys_table()]):
+                yield self.removed_row(metrics, row)
+        for row in self.recs_map.values():
+            yield self.created_row(row)
+
+    async def aiter_hashed(self, dimensions, metrics):
+        hasher = tuple_hasher(dimensions)
+        for row in self.data:
+            self.recs_map[hasher(row)] = row
+        q, removed_q = self.prepare_hash_queries(dimensions, metrics, hasher)
+        async for row in self.ch.objects_stream(q):
+            rec = self.handle_hashed_record(row, metrics)
+            if rec:
+                yield rec
+        if self.removed_keys:
+            async for row in self.ch.objects_stream(removed_q, external=[self.removed_keys_table()]):
+                yield self.removed_row(metrics, row)
+        for row in self.recs_map.values():
+            yield self.created_row(row)
+
+    def external_table(self, dims, metrics):
+        columns = {c: t for c, t in self.disco.columns.items() if c in dims or c in metrics}
+        return ExternalTable(NEW_DATA_TABLE, columns, self.data)
+
+    def updated_row(self, metrics, new_row, row):
+        delta = self.metrics_diff(metrics, new_row, row)
+        if delta:
+            self._stat['update'] += 1
+            correct_row = new_row.copy()
+            correct_row.update(delta)
+            return correct_row
+        self._stat['unchanged'] += 1
+
+    def removed_row(self, metrics, row):
+        self._stat['remove'] += 1
+        return self.negative_row(metrics, row)
+
+    def created_row(self, row):
+        self._stat['create'] += 1
+        return row
+
+    def server_row(self, row):
+        self._stat[row.pop(DELTA_COLUMN)] += 1
+        return row
+
     def handle_record(self, row, dimensions, metrics):
         key = self.dim_key(dimensions, row)
         new_row = self.recs_map.get(key)
         if new_row:
             self.handled_keys.append(key)
-            delta = self.metrics_diff(metrics, new_row, row)
-            if delta:
-                self._stat['update'] += 1
-                correct_row = new_row.copy()
-                correct_row.update(delta)
-                return correct_row
-            else:
-                self._stat['unchanged'] += 1
+            return self.updated_row(metrics, new_row, row)
         # Removing existing record
         else:
-            self._stat['remove'] += 1
-            rm_row = self.negative_row(metrics, row)
-            return rm_row
+            return self.removed_row(metrics, row)
+
+    @staticmethod
+    def sorted_keys(rows, key):
+        """
+        Yields (key, row) of sorted input. Of rows with the same key the last one is used
+        """
+        prev_key = prev = None
+        for row in rows:
+            k = key(row)
+            if prev is not None:
+                if k < prev_key:
+                    raise ValueError(f'Data is not sorted by dimensions: {k} after {prev_key}')
+                if k != prev_key:
+                    yield prev_key, prev
+            prev_key, prev = k, row
+        if prev is not None:
+            yield prev_key, prev
+
+    def merge_step(self, old, new, metrics):
+        """
+        Compares heads of stored (old) and new sorted streams.
+        Returns (correction row or None, advance old, advance new)
+        """
+        if new is None or (old is not None and old[0] < new[0]):
+            return self.removed_row(metrics, old[1]), True, False
+        if old is None or new[0] < old[0]:
+            return self.created_row(new[1]), False, True
+        return self.updated_row(metrics, new[1], old[1]), True, True
+
+    def sorted_dimensions(self, dimensions):
+        return {c: t for c, t in self.disco.columns.items() if c in dimensions}
+
+    def iter_sorted(self, dimensions, metrics):
+        dimensions = self.sorted_dimensions(dimensions)
+        key = key_function(dimensions)
+        q = self.prepare_query(dimensions, metrics, order=True)
+        old_rows = ((key(row), row) for row in self.ch.objects_stream(q))
+        new_rows = self.sorted_keys(self.data, key)
+        old, new = next(old_rows, None), next(new_rows, None)
+        while old is not None or new is not None:
+            rec, next_old, next_new = self.merge_step(old, new, metrics)
+            if rec:
+                yield rec
+            if next_old:
+                old = next(old_rows, None)
+            if next_new:
+                new = next(new_rows, None)
+
+    async def aiter_sorted(self, dimensions, metrics):
+        dimensions = self.sorted_dimensions(dimensions)
+        key = key_function(dimensions)
+        q = self.prepare_query(dimensions, metrics, order=True)
+        old_rows = self.ch.objects_stream(q).__aiter__()
+        new_rows = self.sorted_keys(self.data, key)
+
+        async def next_old_row():
+            try:
+                row = await old_rows.__anext__()
+            except StopAsyncIteration:
+                return None
+            return key(row), row
+
+        old, new = await next_old_row(), next(new_rows, None)
+        while old is not None or new is not None:
+            rec, next_old, next_new = self.merge_step(old, new, metrics)
+            if rec:
+                yield rec
+            if next_old:
+                old = await next_old_row()
+            if next_new:
+                new = next(new_rows, None)
 
     def __iter__(self):
         dimensions = self.disco.get_dimensions()
         metrics = self.disco.get_metrics()
+        if self.mode == SORTED:
+            yield from self.iter_sorted(dimensions, metrics)
+            return
+        if self.mode == SERVER:
+            q = self.prepare_delta_query(dimensions, metrics)
+            for row in self.ch.objects_stream(q, external=[self.external_table(dimensions, metrics)]):
+                yield self.server_row(row)
+            return
+        if self.hash_keys:
+            yield from self.iter_hashed(dimensions, metrics)
+            return
         for row in self.data:
             self.recs_map[self.dim_key(dimensions, row)] = row
         q = self.prepare_query(dimensions, metrics)
@@ -138,13 +482,25 @@ class DeltaGenerator:
 
         # new rows
         for new_key in set(self.recs_map.keys()) - set(self.handled_keys):
-            self._stat['create'] += 1
             row = self.recs_map.get(new_key)
-            yield row 
+            yield self.created_row(row)
     
     async def __aiter__(self):
         dimensions = self.disco.get_dimensions()
         metrics = self.disco.get_metrics()
+        if self.mode == SORTED:
+            async for rec in self.aiter_sorted(dimensions, metrics):
+                yield rec
+            return
+        if self.mode == SERVER:
+            q = self.prepare_delta_query(dimensions, metrics)
+            async for row in self.ch.objects_stream(q, external=[self.external_table(dimensions, metrics)]):
+                yield self.server_row(row)
+            return
+        if self.hash_keys:
+            async for rec in self.aiter_hashed(dimensions, metrics):
+                yield rec
+            return
         for row in self.data:
             self.recs_map[self.dim_key(dimensions, row)] = row
         q = self.prepare_query(dimensions, metrics)
@@ -158,7 +514,7 @@ class DeltaGenerator:
         # new rows
         for new_key in set(self.recs_map.keys()) - set(self.handled_keys):
             row = self.recs_map.get(new_key)
-            yield row 
+            yield self.created_row(row)
 
     def run(self, data):
         metrics = self.disco.get_metrics()
@@ -184,3 +540,135 @@ class DeltaGenerator:
         for new_key in set(self.recs_map.keys()) - set(self.handled_keys):
             row = self.recs_map.get(new_key)
             yield row
+
+
+class PartitionDone:
+
+    __slots__ = ('error',)
+
+    def __init__(self, error=None):
+        self.error = error
+
+
+class PartitionedDeltaGenerator(DeltaWriter):
+    """
+    Splits range by days or months (`toYYYYMM` partitions) of `date_field`
+    and runs diff of every part separately, at most `concurrency` at once:
+    in thread pool when iterated by `for`, as tasks when iterated by `async for`.
+    Rows of parts are yielded as they come, stat is sum of stats of parts.
+    New data is split by date, rows out of partitions of range raise ValueError
+    """
+
+    QUEUE_SIZE = 1000
+
+    def __init__(self, discovery, ch, d1, d2, data, partition=MONTH, concurrency=4, **kwargs):
+        if not discovery.date_field:
+            raise ValueError('Date field is required to split range')
+        self.disco = discovery
+        self.ch = ch
+        self.d1 = d1
+        self.d2 = d2
+        self.data = data
+        self.partition = partition
+        self.concurrency = concurrency
+        self.kwargs = kwargs
+        self.ranges = partition_ranges(d1, d2, partition)
+        self.generators = []
+
+    @property
+    def stat(self):
+        stat = {'update': 0, 'remove': 0, 'create': 0, 'unchanged': 0}
+        for gen in self.generators:
+            for k, v in gen.stat.items():
+                stat[k] += v
+        return stat
+
+    def split(self):
+        length = PARTITION_KEY_LENGTH[self.partition]
+        parts = {d1[:length]: [] for d1, _ in self.ranges}
+        date_field = self.disco.date_field
+        for row in self.data:
+            part = parts.get(to_date(row.get(date_field))[:length])
+            if part is None:
+                raise ValueError(f'Date of row {row} is out of range {self.d1} - {self.d2}')
+            part.append(row)
+        return parts.values()
+
+    def create_generators(self):
+        self.generators = [
+            DeltaGenerator(discovery=self.disco, ch=self.ch, d1=d1, d2=d2, data=data, **self.kwargs)
+            for (d1, d2), data in zip(self.ranges, self.split())]
+        return self.generators
+
+    def __iter__(self):
+        generators = self.create_generators()
+        queue = Queue(self.QUEUE_SIZE)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def run(gen):
+            try:
+                for row in gen:
+                    if not put(row):
+                        return
+            except Exception as e:
+                put(PartitionDone(e))
+            else:
+                put(PartitionDone())
+
+        executor = ThreadPoolExecutor(self.concurrency)
+        futures = [executor.submit(run, gen) for gen in generators]
+        try:
+            done = 0
+            while done < len(generators):
+                item = queue.get()
+                if item.__class__ is PartitionDone:
+                    if item.error:
+                        raise item.error
+                    done += 1
+                else:
+                    yield item
+        finally:
+            # release workers waiting for free place in queue, skip not started parts
+            stop.set()
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+
+    async def __aiter__(self):
+        generators = self.create_generators()
+        queue = asyncio.Queue(self.QUEUE_SIZE)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(gen):
+            try:
+                async with semaphore:
+                    async for row in gen:
+                        await queue.put(row)
+            except Exception as e:
+                await queue.put(PartitionDone(e))
+            else:
+                await queue.put(PartitionDone())
+
+        tasks = [asyncio.ensure_future(run(gen)) for gen in generators]
+        try:
+            done = 0
+            while done < len(tasks):
+                item = await queue.get()
+                if item.__class__ is PartitionDone:
+                    if item.error:
+                        raise item.error
+                    done += 1
+                else:
+                    yield item
+        finally:
+            for task in tasks:
+                task.cancel()
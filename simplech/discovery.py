@@ -1,26 +1,161 @@
 import re
 import inspect
+import random
 import ujson
-import datetime
 from collections import defaultdict, Counter
 from typing import List, Dict, Mapping, Set, Callable, Any
 from pydantic import BaseModel
 from .deltagen import DeltaGenerator, DeltaRunner
-from .helpers import cast_string, is_date, max_type
+from .helpers import cast_string, cast_strings, is_date, date_re
+from .types import TYPES_PRIORITY
 from . import types as cht
+from .types import PYTOCH_MAP
+from .encoder import compile_json_encoder
 from .log import logger
 
-PYTOCH_MAP = {
-    str: cht.String,
-    float: cht.Float64,
-    int: cht.Int64,
-    datetime.date: cht.Date,
-    datetime.datetime: cht.DateTime
-}
+
+# Only strings starting with these chars can be numbers or dates
+NUMERIC_START = frozenset('-0123456789')
+SHAPE_TABLE = str.maketrans('0123456789', '9999999999')
 
 
 class Guesstimator:
-    pass
+    """
+    Streaming inference of columns types. Records are fed one by one, so input
+    can be any iterator.
+
+    analyze_strings: detect numbers and dates in string values
+    limit: max number of records to analyze, `None` - all
+    sample: analyze uniform (reservoir) sample of `limit` records from the whole input
+        instead of first `limit` records
+    stable_after: stop inferring column after its type did not change for that many values.
+        Columns which reached `String` are never inferred again
+    cache_size: max number of cached string shapes
+    batch_size: string values of column are cast by batches of that size
+    """
+
+    def __init__(self, analyze_strings=True, limit=500, sample=False, stable_after=None, cache_size=10000,
+                 batch_size=256, seed=None):
+        self.analyze_strings = analyze_strings
+        self.limit = limit
+        self.sample = sample and limit is not None
+        self.stable_after = stable_after
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.rows = 0
+        self.seen = 0
+        self._types = {}
+        # columns in order of first value, types of strings may be known later
+        self._columns = {}
+        self._stable = Counter()
+        self._done = set()
+        self._shapes = {}
+        # column -> string values waiting to be cast
+        self._pending = defaultdict(list)
+        self._reservoir = []
+        self._random = random.Random(seed)
+
+    def cast(self, values):
+        """
+        Types of string values of column. Results are cached by value shape (digits replaced),
+        except date-like values, which validity depends on digits. Values not found in cache
+        are cast by one batch
+        """
+        types = [None] * len(values)
+        unknown = []
+        for i, value in enumerate(values):
+            if not value or value[0] not in NUMERIC_START:
+                types[i] = cht.String
+                continue
+            if not date_re.match(value):
+                types[i] = self._shapes.get(value.translate(SHAPE_TABLE))
+            if types[i] is None:
+                unknown.append(i)
+        if unknown:
+            cast = cast_strings([values[i] for i in unknown])
+            for i, t in zip(unknown, cast):
+                types[i] = t
+                value = values[i]
+                if not date_re.match(value) and len(self._shapes) < self.cache_size:
+                    self._shapes[value.translate(SHAPE_TABLE)] = t
+        return types
+
+    def _analyze(self, record):
+        if not isinstance(record, dict):
+            raise TypeError(f'Wrong data type. Expected dict given {type(record)}')
+        self.rows += 1
+        done = self._done
+        columns = self._columns
+        for k, v in record.items():
+            if k in done or v is None:
+                continue
+            if k not in columns:
+                columns[k] = None
+            t = type(v)
+            t = PYTOCH_MAP.get(t, t)
+            if self.analyze_strings and (t is str or t is cht.String):
+                pending = self._pending[k]
+                pending.append(v)
+                if len(pending) >= self.batch_size:
+                    self._cast_pending(k)
+                continue
+            self._add_type(k, t.__name__)
+
+    def _cast_pending(self, k):
+        values = self._pending.pop(k)
+        for t in self.cast(values):
+            if k in self._done:
+                break
+            self._add_type(k, t.__name__)
+
+    def _add_type(self, k, name):
+        current = self._types.get(k)
+        if current is None or TYPES_PRIORITY[name] > TYPES_PRIORITY[current]:
+            self._types[k] = name
+            self._stable[k] = 0
+            if name == 'String':
+                self._done.add(k)
+        elif self.stable_after:
+            self._stable[k] += 1
+            if self._stable[k] >= self.stable_after:
+                self._done.add(k)
+
+    def feed(self, record):
+        """
+        Returns False when no more records needed
+        """
+        self.seen += 1
+        if self.sample:
+            if len(self._reservoir) < self.limit:
+                self._reservoir.append(record)
+            else:
+                i = self._random.randrange(self.seen)
+                if i < self.limit:
+                    self._reservoir[i] = record
+            return True
+        self._analyze(record)
+        return self.limit is None or self.rows < self.limit
+
+    def update(self, records):
+        if isinstance(records, dict):
+            records = [records]
+        for record in records:
+            if not self.feed(record):
+                break
+        return self
+
+    def result(self):
+        """
+        Returns dict column name -> type
+        """
+        if self._reservoir:
+            reservoir, self._reservoir = self._reservoir, []
+            for record in reservoir:
+                self._analyze(record)
+        for k in list(self._pending):
+            self._cast_pending(k)
+        types = self._types
+        return {cname: getattr(cht, types[cname]) for cname in self._columns if cname in types}
 
 
 class TableDescription(BaseModel):
@@ -42,13 +177,14 @@ class TableDiscovery:
         arguments:
         table - table name
         ch - ClikHouse / AsyncClickHouse instance
-        records - one record (dict) or list of records (list[dict])
-        limit - discover by only x records
+        records - one record (dict), list or iterator of records (list[dict])
+        limit - discover by only x records, see `Guesstimator` for other options
         """
         
         self.ch = ch
         self.table = table
         self.tc = TableDescription()
+        self._encoder = None
         self.fillfuled = False
         self._stat = {
             'push': 0,
@@ -63,6 +199,7 @@ class TableDiscovery:
         
         if columns:
             self.tc.columns = self.process_provided_config(columns)
+        self._encoder = None
 
 
     @property
@@ -83,36 +220,70 @@ class TableDiscovery:
             res[cname] = ctype
         return res
 
-    def discover_by_data(self, records, analyze_strings=True, limit=500):
-        if isinstance(records, dict):
-            records = dict.values()
-        
-        cols = dict()
-        for i, d in enumerate(records):
-            if not isinstance(d, dict):
-                raise TypeError(
-                    f'Wrong data type. Expected dict given {type(d)}')
-            for k, v in d.items():
-                t = type(v)
-                typech = PYTOCH_MAP.get(t)
-                if typech:
-                    t = typech
-                if analyze_strings and (t == str or t == cht.String):
-                    t = cast_string(v)
-                cols[k] = cols.get(k, Counter())
-                cols[k].update([t.__name__])
-        if i > 0:
+    def discover_by_data(self, records, analyze_strings=True, limit=500, **kwargs):
+        guess = Guesstimator(analyze_strings=analyze_strings, limit=limit, **kwargs).update(records)
+        if guess.rows > 1:
             self.fillfuled = True
-            self._stat['used_rows'] = i
-        
-        return {cname: getattr(cht, max_type(counter)) for cname, counter in cols.items()}
+        self._stat['used_rows'] = guess.rows
+        return guess.result()
+
+    @property
+    def encoder(self):
+        """
+        Compiled JSONEachRow encoder of known columns, rebuilt when columns are changed by `set`
+        """
+        if self._encoder is None:
+            self._encoder = compile_json_encoder(self.columns)
+        return self._encoder
 
     def push(self, row):
         self._stat['push'] += 1
-        return self.ch.push(self.table, row)
+        if self.table in self.ch._row_tables:
+            # encoded by buffer on flush
+            return self.ch.push(self.table, row)
+        return self.ch.push(self.table, self.encoder(row), jsonDump=False)
+
+    def push_many(self, rows):
+        if self.table in self.ch._row_tables:
+            rows = list(rows)
+            self._stat['push'] += len(rows)
+            return self.ch.push_many(self.table, rows)
+        encode = self.encoder
+        rows = [encode(row) for row in rows]
+        self._stat['push'] += len(rows)
+        return self.ch.push_many(self.table, rows, jsonDump=False)
+
+    def by_partition(self, **options):
+        """
+        Rows pushed to table are buffered separately for every partition (month of `date_field`,
+        as in `merge_tree()`), so every insert writes to single partition.
+        options: other buffer options of table, limits are applied to every partition
+        """
+        if not self.date_field:
+            raise ValueError('Date field is required to split rows by partitions')
+        self.ch.configure_buffer(self.table, partition=self, **options)
+        return self
 
-    def difference(self, d1, d2, data, dimensions_criteria=None):
-        return DeltaRunner(discovery=self, ch=self.ch, d1=d1, d2=d2, data=data, dimensions_criteria=dimensions_criteria)
+    def aggregate(self, **options):
+        """
+        Rows pushed to table are summed by dimensions in client buffer until flush,
+        one row per dimensions tuple is sent. For additive metrics only.
+        options: other buffer options of table, `buffer_limit` limits number of distinct dimensions
+        """
+        self.get_metrics()
+        self.ch.configure_buffer(self.table, aggregate=self, **options)
+        return self
+
+    def difference(self, d1, d2, data, dimensions_criteria=None, mode='memory', partition=None, concurrency=4,
+                   hash_keys=False):
+        """
+        Returns context manager yielding DeltaGenerator, see it for `mode` and `hash_keys` description.
+        With `partition` (`day` or `month`) range is split and parts are compared
+        concurrently, at most `concurrency` at once, see PartitionedDeltaGenerator
+        """
+        return DeltaRunner(
+            discovery=self, ch=self.ch, d1=d1, d2=d2, data=data, dimensions_criteria=dimensions_criteria,
+            mode=mode, partition=partition, concurrency=concurrency, hash_keys=hash_keys)
 
     def date(self, *args):
         for k in args:
@@ -180,7 +351,7 @@ class TableDiscovery:
     def set(self, *args, set_main=False, **kwargs):
         """
         Possible to user classes int, str, float and values 1, 'val', 1.0
-        For date can set is main
+        For date (or datetime) can set is main
         """
 
         from_args = dict(zip(args[::2], args[1::2]))
@@ -191,7 +362,8 @@ class TableDiscovery:
             if not inspect.isclass(type_py):
                 type_py = type(type_py)
             self.tc.columns[key] = type_py
-            if is_date(type_py):
+            self._encoder = None
+            if is_date(type_py) or (set_main and type_py is cht.DateTime):
                 if not self.tc.date_field or set_main:
                     self.tc.date_field = key
         return self
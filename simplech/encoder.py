@@ -0,0 +1,106 @@
+import datetime
+import ujson
+from .rowbinary import type_name
+
+
+def to_string(value):
+    if value is None:
+        return ''
+    if isinstance(value, bytes):
+        return value.decode(errors='replace')
+    return str(value)
+
+
+def to_int(value):
+    if not value:
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        # numeric strings like '2.0'
+        return int(float(value))
+
+
+def to_float(value):
+    return float(value) if value else 0.0
+
+
+def to_date(value):
+    if isinstance(value, datetime.date):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, int):
+        # days since epoch
+        return value
+    if not value:
+        return '1970-01-01'
+    return str(value)[:10]
+
+
+def to_datetime(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            # unambiguous, does not depend on server timezone
+            return int(value.timestamp())
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, datetime.date):
+        return value.strftime('%Y-%m-%d 00:00:00')
+    if isinstance(value, (int, float)):
+        return int(value)
+    if not value:
+        return 0
+    return str(value)
+
+
+# Column type -> (python class passed as is, converter of other values)
+CONVERTERS = {
+    'String': (str, 'to_string'),
+    'Date': (str, 'to_date'),
+    'DateTime': (str, 'to_datetime'),
+    'Float32': (float, 'to_float'),
+    'Float64': (float, 'to_float'),
+}
+INT_CONVERTER = (int, 'to_int')
+
+NAMESPACE = {
+    'dumps': ujson.dumps,
+    'str': str,
+    'int': int,
+    'float': float,
+    'to_string': to_string,
+    'to_int': to_int,
+    'to_float': to_float,
+    'to_date': to_date,
+    'to_datetime': to_datetime,
+}
+
+
+def compile_json_encoder(columns):
+    """
+    Generates function row -> JSONEachRow line (without newline), which writes only
+    given columns in fixed order. Values are converted to column types
+    (date, datetime, Decimal, UUID and others), absent ones replaced by type default.
+
+    columns: dict column name -> type (`simplech.types` class, python type or type name)
+    """
+    lines = ['def encode(row):', '    get = row.get']
+    items = []
+    for i, (name, ctype) in enumerate(columns.items()):
+        ctype = type_name(ctype)
+        var = f'v{i}'
+        lines.append(f'    {var} = get({name!r})')
+        converter = CONVERTERS.get(ctype)
+        if not converter and ctype.startswith(('Int', 'UInt')):
+            converter = INT_CONVERTER
+        if converter:
+            cls, convert = converter
+            # skip call for values of exact expected type
+            items.append(f'{name!r}: {var} if {var}.__class__ is {cls.__name__} else {convert}({var})')
+        else:
+            items.append(f'{name!r}: {var}')
+    lines.append('    return dumps({' + ', '.join(items) + '}, ensure_ascii=False, double_precision=15)')
+    source = '\n'.join(lines)
+    namespace = dict(NAMESPACE)
+    exec(compile(source, '<json encoder>', 'exec'), namespace)
+    encode = namespace['encode']
+    encode.source = source
+    return encode
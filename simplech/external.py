@@ -0,0 +1,56 @@
+import uuid
+from .encoder import compile_json_encoder
+from .rowbinary import type_name
+
+
+JSONEACHROW = 'JSONEachRow'
+
+
+class ExternalTable:
+    """
+    Temporary table sent to server along with query (ClickHouse external data).
+    Available in query by its name, for example `SELECT * FROM name`
+
+    name: table name
+    columns: dict column name -> type (`simplech.types` class, python type or type name)
+    rows: iterable of dicts, encoded to JSONEachRow by columns
+    """
+
+    def __init__(self, name, columns, rows):
+        self.name = name
+        self.columns = columns
+        self.rows = rows
+
+    @property
+    def structure(self):
+        return ', '.join(f'`{name}` {type_name(ctype)}' for name, ctype in self.columns.items())
+
+    def params(self):
+        return {
+            f'{self.name}_format': JSONEACHROW,
+            f'{self.name}_structure': self.structure
+        }
+
+    def content(self):
+        encode = compile_json_encoder(self.columns)
+        return '\n'.join([encode(row) for row in self.rows] + ['']).encode()
+
+
+def encode_external(tables):
+    """
+    Returns query params, multipart/form-data body and headers for sending external tables
+    """
+    boundary = uuid.uuid4().hex
+    params = {}
+    parts = []
+    for table in tables:
+        params.update(table.params())
+        parts.append(
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{table.name}"; filename="{table.name}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'.encode())
+        parts.append(table.content())
+        parts.append(b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+    return params, b''.join(parts), headers
@@ -1,6 +1,5 @@
 import re
 import datetime
-import arrow
 from .types import *
 
 
@@ -9,6 +8,11 @@ numeric_re = re.compile(r'^(\-?\d+\.)?\-?[\d]+$')
 date_re = re.compile(r'^\d{2,4}[\-\.\/]\d{2,2}[\-\.\/]\d{2,4}')
 datetime_re = re.compile(
     r'\d{1,4}[\-\.\/]\d{1,2}[\-\.\/]\d{1,4}[T\s]\d{1,2}:\d{1,3}:\d{1,2}')
+# Layouts ClickHouse parses itself: year first, one of `-./` separators,
+# optional time with fraction and timezone
+date_layout_re = re.compile(
+    r'^(\d{4})([\-\.\/])(\d{2})\2(\d{2})'
+    r'(?:[T\s](\d{2}):(\d{2}):(\d{2})(?:\.\d{1,9})?(?:Z|[\+\-]\d{2}:?\d{2})?)?$')
 
 
 def is_date(v):
@@ -31,25 +35,69 @@ def isdatetime_dirty_re(v):
     return bool(datetime_re.match(v))
 
 
+def parse_date(v):
+    """
+    Date / DateTime of value by full parser, None if it is not a date
+    """
+    # arrow is slow to import and to parse, used only for unusual layouts
+    import arrow
+    try:
+        dtt = arrow.get(v).time()
+    except Exception:
+        return None
+    if dtt.hour == 0 and dtt.minute == 0 and dtt.second == 0:
+        return Date
+    return DateTime
+
+
+def cast_date(v):
+    """
+    Date / DateTime of date-like string, None if it is not a date.
+    Values with zero time are Date
+    """
+    m = date_layout_re.match(v)
+    if m is None:
+        return parse_date(v)
+    year, _, month, day, hour, minute, second = m.groups()
+    try:
+        datetime.date(int(year), int(month), int(day))
+    except ValueError:
+        return None
+    if hour is None or hour == minute == second == '00':
+        return Date
+    if int(hour) < 24 and int(minute) < 60 and int(second) < 60:
+        return DateTime
+    return None
+
+
 def cast_string(v):
-    if isdate_dirty_re(v):
-        try:
-            dt = arrow.get(v)
-            dtt = dt.time()
-            if dtt.hour == 0 and dtt.minute == 0 and dtt.second == 0:
-                return Date
-            else:
-                return DateTime
-        except:
-            pass
-    if isnumeric_re(v):
+    if date_re.match(v):
+        t = cast_date(v)
+        if t is not None:
+            return t
+    if numeric_re.match(v):
         if v.count('.') == 0:
             return Int64
-        if isfloat_re(v):
+        if float_re.match(v):
             return Float64
     return String
 
 
+def cast_strings(values):
+    """
+    Types of column of strings. Repeating values are cast once
+    """
+    cache = {}
+    result = []
+    append = result.append
+    for v in values:
+        t = cache.get(v)
+        if t is None:
+            t = cache[v] = cast_string(v)
+        append(t)
+    return result
+
+
 def max_type(counter):
     max_name = None
     max_value = 0
@@ -1,5 +1,6 @@
 from urllib.parse import urlparse, parse_qsl, urlencode
 import io
+import zlib
 import asyncio
 import json as jsonlib
 
@@ -34,10 +35,18 @@ class MockAsyncContent:
             raise StopAsyncIteration
         return line
 
+    async def iter_any(self):
+        while True:
+            chunk = self.buff.read(7)
+            if not chunk:
+                break
+            yield chunk
+
 class HttpClientMock:
     status = 200
     code = 200
     length = 0
+    will_close = False
     buff = io.BytesIO()
     content = b''
 
@@ -54,9 +63,12 @@ class HttpClientMock:
         
         q = params.get('query')
         self.last_method = method.lower()
-        self.last_query = q.lower()
+        self.last_query = q.lower() if q else None
+        self.last_path = u.path
+        self.last_params = params
+        self.last_body = None
 
-        if not q:
+        if not q and u.path != '/ping':
             print('WARNING! not query')
         
         json = kwargs.get('json')
@@ -66,19 +78,29 @@ class HttpClientMock:
         if data:
             body = data
         # print(q, body)
+        if self.last_method == 'post':
+            self.last_body = body
         if self.last_method == 'post' and q and self.last_query.startswith('insert') and body:
-            if isinstance(body, io.BytesIO):
-                body = body.getvalue()
+            if hasattr(body, 'read'):
+                body = body.read()
+            self.last_headers = kwargs.get('headers') or {}
+            if self.last_headers.get('Content-Encoding') in ('gzip', 'deflate'):
+                body = zlib.decompress(body, 47)
             self.mock_store.buff.write(body)
             print('writing', body)
-        if self.last_method == 'get' and q and self.last_query.startswith('select'):
+        # selects with external data are sent by POST
+        if q and self.last_query.startswith('select'):
             self.process_select()
         return self
 
     def getresponse(self):
         return self
 
-    def read(self):
+    def read(self, amt=None):
+        if self.last_path == '/ping':
+            return b'Ok.\n'
+        if amt is not None:
+            return self.mock_store.buff.read(amt)
         # if self.last_method == 'get' and self.last_query and self.last_query.startswith('select'):
         self.mock_store.buff.seek(0, 0)
         r = self.mock_store.buff.getvalue()
@@ -94,8 +116,21 @@ class HttpClientMock:
     def set_debuglevel(self, level):
         pass
 
+    def connect(self):
+        pass
+
+    def isclosed(self):
+        return True
+
+    def getheader(self, name, default=None):
+        return default
+
+    def close(self):
+        pass
+
 
 class AsyncHttpClientMock(HttpClientMock):
+    closed = False
 
     def process_select(self):
         super().process_select()
@@ -119,6 +154,9 @@ class AsyncHttpClientMock(HttpClientMock):
     async def text(self):
         return super().read().decode()
 
+    async def close(self):
+        self.closed = True
+
 
 def create_factory(async_mode=False):
 
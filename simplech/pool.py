@@ -0,0 +1,107 @@
+import select
+import threading
+from collections import deque
+from time import monotonic
+from .log import logger
+
+
+class ConnectionPool:
+    """
+    Thread-safe bounded pool of keep-alive http connections.
+
+    Connections are created lazily by `factory`. At most `maxsize` connections
+    (idle and checked out) exist at the same time; `acquire` waits for a free one
+    up to `timeout` seconds. Connections idle for more than `idle_timeout` seconds
+    or closed by the server are dropped instead of being reused.
+    """
+
+    def __init__(self, factory, maxsize=10, idle_timeout=60, timeout=None):
+        self.factory = factory
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def is_stale(conn):
+        """
+        Idle keep-alive socket should not be readable. If it is, server closed
+        connection (EOF) or sent garbage, so connection can't be reused.
+        """
+        sock = getattr(conn, 'sock', None)
+        if sock is None:
+            # http.client reconnects automatically on next request
+            return False
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def _evict(self, now):
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.popleft()
+            self._drop(conn)
+
+    def _drop(self, conn):
+        self._size -= 1
+        self._cond.notify()
+        try:
+            conn.close()
+        except Exception:
+            logger.debug('error while closing connection', exc_info=True)
+
+    def acquire(self):
+        """
+        Returns tuple (connection, reused)
+        """
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        with self._cond:
+            while True:
+                now = monotonic()
+                self._evict(now)
+                while self._idle:
+                    conn, _ = self._idle.pop()
+                    if self.is_stale(conn):
+                        logger.debug('dropping stale connection')
+                        self._drop(conn)
+                        continue
+                    return conn, True
+                if self._size < self.maxsize:
+                    self._size += 1
+                    break
+                if deadline is not None and now >= deadline:
+                    raise TimeoutError('Connection pool exhausted')
+                self._cond.wait(None if deadline is None else deadline - now)
+        try:
+            return self.factory(), False
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn):
+        with self._cond:
+            if self._closed:
+                self._drop(conn)
+                return
+            self._idle.append((conn, monotonic()))
+            self._cond.notify()
+
+    def discard(self, conn):
+        with self._cond:
+            self._drop(conn)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._drop(conn)
@@ -0,0 +1,62 @@
+import random
+import asyncio
+import http.client
+import aiohttp
+
+
+# connection errors and timeouts, request can succeed if repeated
+TRANSIENT_ERRORS = (OSError, asyncio.TimeoutError, http.client.HTTPException, aiohttp.ClientError)
+
+
+class ClickHouseHTTPError(Exception):
+    """
+    Server responded with error status
+    """
+
+    def __init__(self, status, message=''):
+        super().__init__(f'ClickHouse HTTP Error {status}: {message}')
+        self.status = status
+
+
+def is_transient(error):
+    """
+    Whether failed request can be retried: connection errors, timeouts and 5xx responses.
+    Client and data errors (bad rows, unknown columns) are not retried
+    """
+    if isinstance(error, ClickHouseHTTPError):
+        return error.status >= 500
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with jitter.
+
+    attempts: total number of attempts, including first one
+    backoff: delay before first retry, seconds. Doubled for every next retry
+    max_backoff: max delay, seconds
+    jitter: part of delay randomized, 0..1
+    """
+
+    def __init__(self, attempts=3, backoff=0.5, max_backoff=30, jitter=0.5):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    @classmethod
+    def create(cls, retry):
+        """
+        Accepts RetryPolicy, number of attempts or None (no retries)
+        """
+        if isinstance(retry, cls):
+            return retry
+        return cls(attempts=retry or 1)
+
+    def delays(self):
+        """
+        Yields delay before every retry
+        """
+        for i in range(self.attempts - 1):
+            delay = min(self.max_backoff, self.backoff * 2 ** i)
+            yield delay * (1 - self.jitter * random.random())
@@ -0,0 +1,372 @@
+import struct
+import calendar
+import datetime
+from .types import PYTOCH_MAP
+
+
+ROWBINARY = 'RowBinary'
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+STRUCT_FORMATS = {
+    'Int8': '<b',
+    'UInt8': '<B',
+    'Int16': '<h',
+    'UInt16': '<H',
+    'Int32': '<i',
+    'UInt32': '<I',
+    'Int64': '<q',
+    'UInt64': '<Q',
+    'Float32': '<f',
+    'Float64': '<d',
+    'Date': '<H',
+    'DateTime': '<I',
+}
+
+
+def type_name(ctype):
+    """
+    Returns ClickHouse type name for `simplech.types` class, python type or name
+    """
+    if isinstance(ctype, str):
+        return ctype
+    ctype = PYTOCH_MAP.get(ctype, ctype)
+    return ctype.__name__
+
+
+def leb128(value):
+    """
+    Unsigned LEB128 (varint), used for strings length
+    """
+    if value < 0x80:
+        return bytes((value,))
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def to_days(value):
+    """
+    Date as days since epoch. Accepts date, datetime or 'YYYY-MM-DD' string
+    """
+    if not value:
+        return 0
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    elif isinstance(value, str):
+        value = datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+    elif isinstance(value, int):
+        return value
+    return value.toordinal() - EPOCH_ORDINAL
+
+
+def to_timestamp(value):
+    """
+    DateTime as unix timestamp. Accepts datetime, date or 'YYYY-MM-DD hh:mm:ss'
+    string. Naive values treated as UTC
+    """
+    if not value:
+        return 0
+    if isinstance(value, str):
+        value = value.strip()
+        if len(value) == 10:
+            return to_days(value) * 86400
+        return calendar.timegm((
+            int(value[0:4]), int(value[5:7]), int(value[8:10]),
+            int(value[11:13]), int(value[14:16]), int(value[17:19])))
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            return int(value.timestamp())
+        return calendar.timegm(value.timetuple())
+    if isinstance(value, datetime.date):
+        return to_days(value) * 86400
+    return int(value)
+
+
+def string_writer(out, value):
+    if value is None:
+        out.append(0)
+        return
+    if not isinstance(value, bytes):
+        value = str(value).encode()
+    out += leb128(len(value))
+    out += value
+
+
+def number_writer(ctype, pack):
+    cast = float if ctype.startswith('Float') else int
+
+    def writer(out, value):
+        out += pack(cast(value) if value else 0)
+    return writer
+
+
+def converting_writer(convert, pack):
+    def writer(out, value):
+        out += pack(convert(value))
+    return writer
+
+
+def column_writer(ctype):
+    name = type_name(ctype)
+    if name == 'String':
+        return string_writer
+    fmt = STRUCT_FORMATS.get(name)
+    if not fmt:
+        raise TypeError(f'Unsupported RowBinary type {name}')
+    pack = struct.Struct(fmt).pack
+    if name == 'Date':
+        return converting_writer(to_days, pack)
+    if name == 'DateTime':
+        return converting_writer(to_timestamp, pack)
+    return number_writer(name, pack)
+
+
+class RowBinaryEncoder:
+    """
+    Encodes dicts into RowBinary format using known columns types.
+    Columns absent in row are filled with type default value.
+
+    columns: dict column name -> type (`simplech.types` class, python type or type name)
+        or TableDiscovery instance
+    """
+
+    def __init__(self, columns):
+        columns = getattr(columns, 'columns', columns)
+        if not columns:
+            raise ValueError('Columns are required for RowBinary format')
+        self.names = list(columns.keys())
+        self._writers = [(name, column_writer(ctype)) for name, ctype in columns.items()]
+
+    def encode(self, row):
+        out = bytearray()
+        get = row.get
+        for name, write in self._writers:
+            write(out, get(name))
+        return bytes(out)
+
+    def encode_many(self, rows):
+        out = bytearray()
+        writers = self._writers
+        for row in rows:
+            get = row.get
+            for name, write in writers:
+                write(out, get(name))
+        return bytes(out)
+
+
+ROWBINARY_WITH_NAMES_AND_TYPES = 'RowBinaryWithNamesAndTypes'
+
+EPOCH_DATETIME = datetime.datetime(1970, 1, 1)
+
+# Raised by readers when chunk ends in the middle of value
+INCOMPLETE = (IndexError, struct.error)
+
+
+def read_leb128(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def read_bytes(data, pos):
+    size, pos = read_leb128(data, pos)
+    end = pos + size
+    if end > len(data):
+        raise IndexError('incomplete string')
+    return data[pos:end], end
+
+
+def string_reader(data, pos):
+    value, pos = read_bytes(data, pos)
+    return value.decode(errors='replace'), pos
+
+
+def fixed_string_reader(size):
+    def reader(data, pos):
+        end = pos + size
+        if end > len(data):
+            raise IndexError('incomplete string')
+        return data[pos:end].rstrip(b'\0').decode(errors='replace'), end
+    return reader
+
+
+def from_days(days):
+    return datetime.date.fromordinal(EPOCH_ORDINAL + days)
+
+
+def from_timestamp(ts):
+    return EPOCH_DATETIME + datetime.timedelta(seconds=ts)
+
+
+VALUE_CONVERTERS = {
+    'Date': from_days,
+    'Date32': from_days,
+    'DateTime': from_timestamp,
+    'Bool': bool,
+}
+
+
+def base_type(ctype):
+    """
+    Strips wrappers, that does not affect binary representation
+    """
+    if ctype.startswith('LowCardinality('):
+        return base_type(ctype[15:-1])
+    if ctype.startswith('DateTime('):
+        return 'DateTime'
+    return ctype
+
+
+def fixed_format(ctype):
+    if ctype == 'Date32':
+        return '<i'
+    if ctype == 'Bool':
+        return '<B'
+    return STRUCT_FORMATS.get(ctype)
+
+
+def column_reader(ctype, raw=False):
+    """
+    Returns function (data, pos) -> (value, new_pos).
+    With `raw` dates are returned as numbers as is
+    """
+    ctype = base_type(ctype)
+    if ctype.startswith('Nullable('):
+        inner = column_reader(ctype[9:-1], raw=raw)
+
+        def nullable_reader(data, pos):
+            if data[pos]:
+                return None, pos + 1
+            return inner(data, pos + 1)
+        return nullable_reader
+    if ctype.startswith('FixedString('):
+        return fixed_string_reader(int(ctype[12:-1]))
+    if ctype == 'String':
+        return string_reader
+    fmt = fixed_format(ctype)
+    if not fmt:
+        raise TypeError(f'Unsupported RowBinary type {ctype}')
+    st = struct.Struct(fmt)
+    unpack_from = st.unpack_from
+    size = st.size
+    convert = None if raw else VALUE_CONVERTERS.get(ctype)
+    if convert:
+        def converting_reader(data, pos):
+            return convert(unpack_from(data, pos)[0]), pos + size
+        return converting_reader
+
+    def reader(data, pos):
+        return unpack_from(data, pos)[0], pos + size
+    return reader
+
+
+class RowBinaryDecoder:
+    """
+    Incremental decoder of RowBinaryWithNamesAndTypes (or RowBinary with known columns) stream.
+    Data is fed by chunks of any size, decoded rows are returned as tuples or dicts.
+
+    columns: dict column name -> type, required for `RowBinary` stream without header
+    as_dict: return rows as dicts instead of tuples
+    """
+
+    def __init__(self, columns=None, as_dict=False):
+        self.as_dict = as_dict
+        self.names = None
+        self.types = None
+        self._tail = b''
+        if columns:
+            self._setup(list(columns.keys()), [type_name(t) for t in columns.values()])
+
+    def _setup(self, names, types):
+        self.names = names
+        self.types = types
+        self._readers = [column_reader(t) for t in types]
+        self._row_struct = None
+        self._converters = None
+        bases = [base_type(t) for t in types]
+        formats = [fixed_format(t) for t in bases]
+        if all(formats):
+            # Only fixed width columns, whole rows can be unpacked at once
+            self._row_struct = struct.Struct('<' + ''.join(f[1:] for f in formats))
+            self._converters = [(i, VALUE_CONVERTERS[t]) for i, t in enumerate(bases) if t in VALUE_CONVERTERS]
+
+    def _read_header(self, data, pos):
+        count, pos = read_leb128(data, pos)
+        names = []
+        types = []
+        for _ in range(count):
+            name, pos = read_bytes(data, pos)
+            names.append(name.decode())
+        for _ in range(count):
+            ctype, pos = read_bytes(data, pos)
+            types.append(ctype.decode())
+        self._setup(names, types)
+        return pos
+
+    def _read_fixed(self, data, pos, rows):
+        size = self._row_struct.size
+        end = pos + (len(data) - pos) // size * size
+        decoded = self._row_struct.iter_unpack(memoryview(data)[pos:end])
+        if self._converters:
+            converters = self._converters
+            for row in decoded:
+                row = list(row)
+                for i, convert in converters:
+                    row[i] = convert(row[i])
+                rows.append(tuple(row))
+        else:
+            rows.extend(decoded)
+        return end
+
+    def _read_rows(self, data, pos, rows):
+        readers = self._readers
+        length = len(data)
+        try:
+            while pos < length:
+                row = []
+                p = pos
+                for read in readers:
+                    value, p = read(data, p)
+                    row.append(value)
+                rows.append(tuple(row))
+                pos = p
+        except INCOMPLETE:
+            pass
+        return pos
+
+    def feed(self, chunk):
+        """
+        Returns list of rows completely contained in received data
+        """
+        data = self._tail + chunk if self._tail else chunk
+        pos = 0
+        rows = []
+        if self.names is None:
+            try:
+                pos = self._read_header(data, pos)
+            except INCOMPLETE:
+                self._tail = data
+                return rows
+        if self._row_struct:
+            pos = self._read_fixed(data, pos, rows)
+        else:
+            pos = self._read_rows(data, pos, rows)
+        self._tail = data[pos:]
+        if self.as_dict:
+            names = self.names
+            return [dict(zip(names, row)) for row in rows]
+        return rows
+
+    def close(self):
+        if self._tail:
+            raise ValueError(f'Unexpected end of RowBinary stream, {len(self._tail)} bytes left')
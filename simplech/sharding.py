@@ -0,0 +1,335 @@
+import struct
+import asyncio
+import datetime
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import ujson
+from .cityhash import city_hash64, int_hash64, hash128to64, MASK
+from .balancer import parse_hosts
+from .rowbinary import to_days, to_timestamp, type_name
+from .encoder import to_string, to_int, to_float, to_datetime
+from .log import logger
+
+
+CITYHASH64 = 'cityHash64'
+INTHASH64 = 'intHash64'
+
+CLUSTER_QUERY = """
+SELECT shard_num, shard_weight, host_name
+FROM system.clusters
+WHERE cluster = '{cluster}'
+ORDER BY shard_num, replica_num
+"""
+
+_float_bits = struct.Struct('<d')
+_uint64 = struct.Struct('<Q')
+_float32_bits = struct.Struct('<f')
+_uint32 = struct.Struct('<I')
+
+INT_BITS = {
+    'Int8': 8, 'Int16': 16, 'Int32': 32, 'Int64': 64,
+    'UInt8': 64, 'UInt16': 64, 'UInt32': 64, 'UInt64': 64,
+}
+FLOAT_BITS = {
+    'Float32': lambda v: _uint32.unpack(_float32_bits.pack(v))[0],
+    'Float64': lambda v: _uint64.unpack(_float_bits.pack(v))[0],
+}
+
+
+def value_hash(value):
+    """
+    Hash of single value as ClickHouse `cityHash64` computes it: strings are hashed
+    by CityHash64, numbers, dates and datetimes by `intHash64` of their binary value.
+    Integers are treated as 64 bit
+    """
+    if isinstance(value, str):
+        return city_hash64(value.encode())
+    if isinstance(value, (bytes, bytearray)):
+        return city_hash64(value)
+    if isinstance(value, float):
+        return int_hash64(_uint64.unpack(_float_bits.pack(value))[0])
+    if isinstance(value, datetime.datetime):
+        return int_hash64(to_timestamp(value))
+    if isinstance(value, datetime.date):
+        return int_hash64(to_days(value))
+    if value is None:
+        value = 0
+    return int_hash64(int(value))
+
+
+def city_hash(*values):
+    """
+    ClickHouse `cityHash64(a, b, ...)`
+    """
+    result = None
+    for value in values:
+        h = value_hash(value)
+        result = h if result is None else hash128to64(result, h)
+    return result
+
+
+def hash_int(value, mask):
+    return int_hash64(to_int(value) & mask)
+
+
+def hash_float(value, bits_of):
+    return int_hash64(bits_of(to_float(value)))
+
+
+def hash_date(value):
+    return int_hash64(to_days(value))
+
+
+def hash_datetime(value):
+    return city_hash64(to_string(to_datetime(value)).encode())
+
+
+def hash_timestamp(value):
+    if isinstance(value, str) and value.isdigit():
+        value = int(value)
+    return int_hash64(to_timestamp(value))
+
+
+def hash_text(value):
+    return city_hash64(to_string(value).encode())
+
+
+def tuple_hasher(columns, native=False):
+    """
+    Function row -> ClickHouse `cityHash64` of given columns, values are converted
+    to column types first. SQL expression computing the same hash is in `expression`
+    attribute. DateTime and not numeric columns are hashed as text
+    (naive datetimes are expected in server timezone).
+
+    native: hash columns themselves, as sharding expression of Distributed table does:
+        DateTime by its timestamp (naive values treated as UTC), columns of other
+        types not listed above raise ValueError
+    """
+    hashers = []
+    args = []
+    for name, ctype in columns.items():
+        ctype = type_name(ctype)
+        arg = f'`{name}`'
+        if ctype in INT_BITS:
+            hasher = partial(hash_int, mask=(1 << INT_BITS[ctype]) - 1)
+        elif ctype in FLOAT_BITS:
+            hasher = partial(hash_float, bits_of=FLOAT_BITS[ctype])
+        elif ctype == 'Date':
+            hasher = hash_date
+        elif native and ctype == 'DateTime':
+            hasher = hash_timestamp
+        elif native and ctype != 'String':
+            raise ValueError(f'Hashing of {ctype} column {name} is not supported')
+        elif ctype == 'DateTime':
+            hasher = hash_datetime
+            arg = f'toString({arg})'
+        else:
+            hasher = hash_text
+            if ctype != 'String':
+                arg = f'toString({arg})'
+        hashers.append((name, hasher))
+        args.append(arg)
+
+    def hash_row(row):
+        result = None
+        for name, hasher in hashers:
+            h = hasher(row.get(name))
+            result = h if result is None else hash128to64(result, h)
+        return result
+
+    hash_row.expression = 'cityHash64(' + ', '.join(args) + ')'
+    return hash_row
+
+
+def shard_slots(weights):
+    """
+    Shard index for every slot, as Distributed engine does: shard `i` takes `weights[i]` slots
+    """
+    slots = []
+    for i, weight in enumerate(weights):
+        slots.extend([i] * weight)
+    return slots
+
+
+class Shard:
+
+    __slots__ = ('num', 'weight', 'hosts')
+
+    def __init__(self, num, hosts, weight=1):
+        self.num = num
+        self.hosts = hosts
+        self.weight = weight
+
+    def __repr__(self):
+        return f'<Shard {self.num} weight={self.weight} {self.hosts}>'
+
+
+class ShardRouter:
+    """
+    Writes rows straight to local tables of shards, bypassing Distributed table.
+    Shard of row is chosen the same way as Distributed engine does:
+    `sharding expression % total weight` mapped to shards by their weights.
+
+    Every shard has own client (of the same class as `ch`), balancing requests
+    between shard replicas and keeping own buffer.
+
+    ch: ClickHouse / AsyncClickHouse instance, connection settings are taken from it
+    table: local table name
+    sharding_key: column name, tuple of column names or function row -> int
+    hash: `cityHash64` (default), `intHash64` or `None` to use integer value of key as is
+    columns: dict column name -> type or TableDiscovery of table. With column types key values
+        are converted to them before hashing (`tuple_hasher`), as server hashes them,
+        otherwise values are hashed by their python types
+    shards: list of shards: `host[:port]` string (replicas separated by comma),
+        list of replicas or dict with `hosts` and `weight` keys
+    cluster: name of cluster to read shards from `system.clusters`, if `shards` is not set.
+        For AsyncClickHouse topology is read by `await router.discover()` or `async with router`
+    http_port: port of replicas read from `system.clusters`, default to port of `ch`
+    options: arguments for shard clients (`buffer_limit`, `compression` and others)
+    """
+
+    def __init__(self, ch, table, sharding_key, shards=None, cluster=None, hash=CITYHASH64, http_port=None,
+                 columns=None, **options):
+        if hash not in (CITYHASH64, INTHASH64, None):
+            raise ValueError(f'Unsupported sharding hash {hash}')
+        if shards is None and cluster is None:
+            raise ValueError('Either shards or cluster is required')
+        self.ch = ch
+        self.table = table
+        self.cluster = cluster
+        self.http_port = http_port or ch.port
+        self.options = options
+        self.shards = []
+        self.clients = []
+        self._slots = []
+        self._async = asyncio.iscoroutinefunction(ch.select)
+        self._key = self._key_function(sharding_key, hash, columns)
+        if shards is not None:
+            self._setup([self._make_shard(i + 1, shard) for i, shard in enumerate(shards)])
+        elif not self._async:
+            self.discover()
+
+    def _make_shard(self, num, shard):
+        weight = 1
+        if isinstance(shard, dict):
+            weight = shard.get('weight', 1)
+            shard = shard['hosts']
+        return Shard(num, parse_hosts(shard, self.http_port), weight)
+
+    @staticmethod
+    def _key_function(sharding_key, hash, columns=None):
+        if callable(sharding_key):
+            return sharding_key
+        names = (sharding_key,) if isinstance(sharding_key, str) else tuple(sharding_key)
+        if hash == CITYHASH64:
+            if columns is not None:
+                # TableDiscovery or dict
+                columns = getattr(columns, 'columns', columns)
+                missing = [name for name in names if name not in columns]
+                if missing:
+                    raise ValueError(f'Types of sharding key columns {missing} are unknown')
+                return tuple_hasher({name: columns[name] for name in names}, native=True)
+            return lambda row: city_hash(*[row.get(name) for name in names])
+        if len(names) > 1:
+            raise ValueError(f'Several columns can be used only with {CITYHASH64}')
+        name = names[0]
+        # intHash64 takes integers as 64 bit, sign extended
+        if hash == INTHASH64:
+            return lambda row: int_hash64(to_int(row.get(name)))
+        return lambda row: to_int(row.get(name))
+
+    def _setup(self, shards):
+        if not shards:
+            raise ValueError(f'No shards found for cluster {self.cluster}')
+        self.shards = shards
+        self._slots = shard_slots([shard.weight for shard in shards])
+        self.clients = [self._make_client(shard) for shard in shards]
+
+    def _make_client(self, shard):
+        ch = self.ch
+        client = type(ch)(
+            host=shard.hosts, db=ch.db, user=ch.user, password=ch.password,
+            scheme=ch.scheme, loop=getattr(ch, 'loop', None), **self.options)
+        client.conn_class = ch.conn_class
+        return client
+
+    def _parse_topology(self, data):
+        shards = {}
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            rec = ujson.loads(line)
+            num = int(rec['shard_num'])
+            if num not in shards:
+                shards[num] = Shard(num, [], int(rec['shard_weight']))
+            shards[num].hosts.append(f"{rec['host_name']}:{self.http_port}")
+        return [shards[num] for num in sorted(shards)]
+
+    def discover(self):
+        """
+        Reads shards from `system.clusters`. For AsyncClickHouse returns coroutine
+        """
+        cluster = self.cluster.replace('\\', '\\\\').replace("'", "\\'")
+        result = self.ch.select(CLUSTER_QUERY.format(cluster=cluster) + ' FORMAT JSONEachRow')
+        if asyncio.iscoroutine(result):
+            return self._discover_async(result)
+        self._setup(self._parse_topology(result or ''))
+        return self
+
+    async def _discover_async(self, result):
+        self._setup(self._parse_topology(await result or ''))
+        return self
+
+    def shard_index(self, row):
+        """
+        Index of shard in `shards` for row
+        """
+        return self._slots[(self._key(row) & MASK) % len(self._slots)]
+
+    def push(self, doc):
+        self.clients[self.shard_index(doc)].push(self.table, doc)
+
+    def push_many(self, docs):
+        by_shard = [[] for _ in self.clients]
+        for doc in docs:
+            by_shard[self.shard_index(doc)].append(doc)
+        for client, shard_docs in zip(self.clients, by_shard):
+            if shard_docs:
+                client.push_many(self.table, shard_docs)
+
+    def flush(self):
+        """
+        Writes buffers of all shards in parallel
+        """
+        if not self.clients:
+            return
+        if self._async:
+            return asyncio.gather(*[client.flush_all() for client in self.clients])
+        with ThreadPoolExecutor(len(self.clients)) as executor:
+            return list(executor.map(lambda client: client.flush_all(), self.clients))
+
+    def close(self):
+        """
+        Flushes buffers and closes shard clients
+        """
+        if self._async:
+            return asyncio.gather(*[client.close() for client in self.clients])
+        for client in self.clients:
+            try:
+                client.close()
+            except Exception:
+                logger.exception('error while closing shard client')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    async def __aenter__(self):
+        if not self.clients:
+            await self.discover()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
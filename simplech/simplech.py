@@ -1,21 +1,40 @@
-from collections import defaultdict
-from time import time
+from time import time, monotonic, sleep
+from collections import OrderedDict, deque
+from concurrent.futures import Future
 import os
 import io
+import atexit
+import threading
 import http.client
+from contextlib import contextmanager, asynccontextmanager
+from functools import partial
 import urllib.parse
 import ujson
 import asyncio
 import aiohttp
 from .log import logging, logger
-from .write_context import Buffer, WriterContext
+from .write_context import Buffer, AggregatingBuffer, PartitionedBuffer, BufferMap, WriterContext, BACKEND_MEMORY
+from .pool import ConnectionPool
+from .balancer import HostBalancer, LATENCY, parse_hosts
+from .retry import RetryPolicy, ClickHouseHTTPError, is_transient
+from .spool import Spool
+from .sharding import ShardRouter
+from .external import encode_external
+from .rowbinary import RowBinaryDecoder, ROWBINARY_WITH_NAMES_AND_TYPES
+from .columns import ColumnarDecoder
+from .compression import DecompressingReader, DECOMPRESSORS, GZIP, DEFLATE
 from . import TableDiscovery
 from . import DeltaGenerator
 
 
 FORMAT_JSONEACHROW = ' FORMAT JSONEachRow'
+OVERFLOW_WAIT = 'wait'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_SPILL = 'spill'
+
 FORMAT = 'FORMAT'
 JSONEACHROW = 'JSONEachRow'
+CHUNK_SIZE = 65536
 
 
 
@@ -23,6 +42,21 @@ def format_format(val):
     return ' ' + FORMAT + ' ' + val if val else ''
 
 
+def serialize_rows(docs):
+    """
+    Encodes rows to JSONEachRow chunk. Runs in serialize executor, so should stay picklable
+    """
+    dumps = ujson.dumps
+    return '\n'.join([dumps(doc, ensure_ascii=False) for doc in docs] + ['']).encode(), len(docs)
+
+
+def insert_query(table, buff):
+    columns = ''
+    if buff.columns:
+        columns = ' (' + ', '.join(f'`{c}`' for c in buff.columns) + ')'
+    return f'INSERT INTO {table}{columns}' + format_format(buff.format)
+
+
 def none_decoder(val):
     return val
 
@@ -49,21 +83,61 @@ class BaseClickHouse():
 
     # Arguments
 
-    host: (str, None) Хост с clickhouse. Default to `127.0.0.1`.
-    port: (int, None) Порт подключения. Default to `8123`.
+    host: (str, list, None) Хост с clickhouse. Несколько реплик можно указать списком или через запятую,
+        `host:port`. Default to `127.0.0.1`.
+    port: (int, None) Порт подключения, если не указан в хосте. Default to `8123`.
     db: (str, None) Название базы данных. Default to `default`.
+    scheme: (str, None) Протокол `http` или `https`. Default to `http`.
     user: (str, None) Имя пользователя. Default to `default`.
     password: (str, None) Пароль. Default to `""`.
     session: (bool) Использовать сессию. Идентификатор сессии генерируется автоматически. Default to `False`.
     session_id: (str, None) Идентификатор сессии взамен автоматически сгенериованного. Default to `None`.
     dsn: (str, None) Использовать для подключения DSN, например: `http://default@127.0.0.1:8123/stats`. Default to `None`. 
         При наличии переменной окружеения `CH_DSN` или `CLICKHOUSE_DSN` будет использовано ее значение.
+        Несколько хостов указываются через запятую: `http://default@ch1:8123,ch2:8123/stats`.
+    balance: (str) Выбор хоста для запроса: `latency` - с учетом времени ответа, `round_robin` - по очереди.
+        Default to `latency`.
+    down_time: (int, float) Время в секундах, на которое недоступный хост исключается из балансировки. Default to `30`.
+    health_check_interval: (int, float) Интервал проверки хостов запросом `/ping`, в секундах,
+        если хостов несколько. Default to `10`.
     debug: (bool) Переключение логов в режим отладки. Default to `False`.
     buffer_limit: (int) Буффер записи на таблицу. При достижении будет произведена запись в БД. Default to `1000`.
+    buffer_bytes_limit: (int, None) Размер буффера в байтах, при достижении которого будет произведена запись в БД. Default to `None`.
+    buffer_backend: (str) Хранение буффера: `memory` - в памяти, `file` - во временном файле. Default to `memory`.
+    buffer_dir: (str, None) Директория временных файлов для `buffer_backend='file'`. Default to `None` (системная).
+    flush_every: (int, float, None) Максимальное время в секундах хранения данных в буффере. Default to `5`.
+    flush_interval: (int, float) Интервал проверки буфферов фоновой записью, в секундах. Default to `1`.
+    flush_thread: (bool) Запись буфферов в фоновом потоке (для синхронной версии). Default to `False`.
+    max_inflight: (int, None) Максимальное количество одновременных запросов записи (для асинхронной версии). Default to `None`.
+    max_inflight_per_table: (int, None) То же, для одной таблицы. Default to `None`.
+    max_pending_bytes: (int, None) Максимальный объем данных, ожидающих записи (для асинхронной версии). Default to `None`.
+    overflow: (str) Поведение при превышении лимитов: `wait` - `drain()` ожидает освобождения,
+        `drop_oldest` - удаляются самые старые не начатые записи, `spill` - новые записи сохраняются в `spool_dir`
+        (требуются `spool_dir` и `max_pending_bytes`).
+        Default to `wait`.
+    serialize_executor: (Executor, None) Пул (например, `ProcessPoolExecutor`) для сериализации строк в `push_many`.
+        Порядок строк в таблице сохраняется. Default to `None`.
+    retry: (RetryPolicy, int, None) Повтор неудачных запросов записи с экспоненциальной задержкой.
+        Повторяются ошибки соединения, таймауты и ответы 5xx, записи с ошибками данных не повторяются и не сохраняются в `spool_dir`.
+        Число - количество попыток. Default to `None`.
+    spool_dir: (str, None) Директория для сохранения записей, которые не удалось записать в БД.
+        Сохраненные записи отправляются повторно в фоне, когда сервер доступен. Default to `None`.
+    replay_interval: (int, float) Интервал повторной отправки сохраненных записей, в секундах. Default to `30`.
     loop: (EventLoop, None) При необходимости указать конкретный loop (для асинхронной версии). Default to `None`.
     timeout: (int) Время ожидания выполнения запроса. Default `10`.
+    pool_size: (int) Максимальное количество постоянных (keep-alive) соединений. Default `10`.
+    pool_idle_timeout: (int) Время в секундах, после которого неиспользуемое соединение закрывается. Default `60`.
+    pool_size_per_host: (int) Ограничение количества соединений на один хост (для асинхронной версии), `0` - без ограничений. Default `0`.
+    dns_cache_ttl: (int, None) Время кеширования DNS в секундах (для асинхронной версии). Default `10`.
+    compression: (str, bool, None) Сжатие данных при записи: `gzip`, `deflate`, `zstd`, `lz4` или `True` для
+        лучшего из доступных. Default `None`.
+    response_compression: (str, bool, None) Запрашивать ответы сервера в сжатом виде: `gzip`, `deflate` или
+        `True` (gzip). Данные распаковываются по мере чтения. Default `None`.
     """
 
+    # Max chunks per table pending in serialize executor, producer waits above it. None - no limit
+    SERIALIZE_QUEUE = None
+
     def __init__(self,
                  host=None,
                  port=None,
@@ -76,9 +150,33 @@ class BaseClickHouse():
                  debug=False,
                  loop=None,
                  buffer_limit=1000,
-                 timeout=10):
+                 buffer_bytes_limit=None,
+                 buffer_backend=BACKEND_MEMORY,
+                 buffer_dir=None,
+                 flush_every=5,
+                 flush_interval=1,
+                 flush_thread=False,
+                 max_inflight=None,
+                 max_inflight_per_table=None,
+                 max_pending_bytes=None,
+                 overflow=OVERFLOW_WAIT,
+                 serialize_executor=None,
+                 retry=None,
+                 spool_dir=None,
+                 replay_interval=30,
+                 timeout=10,
+                 pool_size=10,
+                 pool_idle_timeout=60,
+                 pool_size_per_host=0,
+                 dns_cache_ttl=10,
+                 compression=None,
+                 response_compression=None,
+                 balance=LATENCY,
+                 down_time=30,
+                 health_check_interval=10,
+                 scheme=None):
 
-        self.scheme = 'http'
+        self.scheme = scheme or 'http'
 
         if debug:
             self.set_debug()
@@ -94,24 +192,65 @@ class BaseClickHouse():
             parts = urllib.parse.urlparse(dsn_lookup)
             # temporary only http supported
             self.scheme = parts.scheme
-            self.host = parts.hostname
-            self.port = parts.port
+            hosts = parse_hosts(parts.netloc.rpartition('@')[2])
             self.db = str(parts.path).strip('/')
             self.user = parts.username
             self.password = parts.password
         else:
-            self.host = host or '127.0.0.1'
-            self.port = port or 8123
+            hosts = parse_hosts(host or '127.0.0.1', port or 8123)
             self.db = db or 'default'
             self.user = user
             self.password = password
 
-        self.base_url = f"{self.host}:{self.port}"
-        self._buffer = defaultdict(Buffer)
-        self._buffer_limit = buffer_limit
+        self.host, _, port = hosts[0].rpartition(':')
+        self.port = int(port)
+        self.base_url = hosts[0]
+        self._balancer = HostBalancer(hosts, strategy=balance, down_time=down_time)
+        self.health_check_interval = health_check_interval
+        self._buffer_options = {
+            'buffer_limit': buffer_limit,
+            'bytes_limit': buffer_bytes_limit,
+            'max_age': flush_every,
+            'compression': compression,
+            'backend': buffer_backend,
+            'directory': buffer_dir,
+            'aggregate': None,
+            'partition': None,
+        }
+        self._table_buffer_options = {}
+        # tables which buffers take rows, not serialized documents
+        self._row_tables = set()
+        if response_compression is True:
+            response_compression = GZIP
+        if response_compression not in (None, False, GZIP, DEFLATE):
+            raise ValueError(f'Unsupported response compression {response_compression}')
+        self.response_compression = response_compression or None
+        self._buffer = BufferMap(self._create_buffer)
         self._timeout = timeout
-        self.flush_every = 5
+        self._pool_size = pool_size
+        self._pool_idle_timeout = pool_idle_timeout
+        self._pool_size_per_host = pool_size_per_host
+        self._dns_cache_ttl = dns_cache_ttl
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._flush_thread = flush_thread
+        self.max_inflight = max_inflight
+        self.max_inflight_per_table = max_inflight_per_table
+        self.max_pending_bytes = max_pending_bytes
+        if overflow not in (OVERFLOW_WAIT, OVERFLOW_DROP_OLDEST, OVERFLOW_SPILL):
+            raise ValueError(f'Unsupported overflow policy {overflow}')
+        if overflow == OVERFLOW_SPILL and not (spool_dir and max_pending_bytes):
+            raise ValueError(f'Overflow policy {overflow} requires spool_dir and max_pending_bytes')
+        self.overflow = overflow
+        self.retry = RetryPolicy.create(retry)
+        self._serializer = serialize_executor
+        # table -> encoded chunks being serialized by executor, in order of submission
+        self._serializing = {}
+        self._serial_lock = threading.RLock()
+        self._spool = Spool(spool_dir) if spool_dir else None
+        self.replay_interval = replay_interval
         self._flush_timer = None
+        self._lock = threading.RLock()
         self.loop = loop
         if session and session_id is None:
             session_id = str(time())
@@ -132,10 +271,54 @@ class BaseClickHouse():
             params['user'] = self.user
         if self.password:
             params['password'] = self.password
+        if self.response_compression:
+            params['enable_http_compression'] = 1
         return params
 
-    def discover(self, table, records=None, columns=None):
-        return TableDiscovery(table=table, ch=self, records=records, columns=columns)
+    def _create_buffer(self, table):
+        options = {**self._buffer_options, **self._table_buffer_options.get(table, {})}
+        aggregate = options.pop('aggregate')
+        partition = options.pop('partition')
+        if aggregate is not None:
+            factory = partial(AggregatingBuffer, aggregate, **options)
+        else:
+            factory = partial(Buffer, **options)
+        if partition is not None:
+            # TableDiscovery or name of date column
+            date_field = getattr(partition, 'date_field', partition)
+            columns = getattr(partition, 'columns', {})
+            return PartitionedBuffer(
+                date_field, factory, encoder=getattr(partition, 'encoder', None), date_type=columns.get(date_field))
+        return factory()
+
+    def configure_buffer(self, table, **options):
+        """
+        Set flush policy and other buffer options for table:
+        `buffer_limit` (rows), `bytes_limit`, `max_age` (seconds), `compression`,
+        `backend` (`memory` or `file`), `directory`,
+        `aggregate` (TableDiscovery to sum metrics of rows with the same dimensions, see `AggregatingBuffer`),
+        `partition` (TableDiscovery or date column to buffer rows by partitions, see `PartitionedBuffer`).
+        Applied to next buffer of table
+        """
+        unknown = set(options) - set(self._buffer_options)
+        if unknown:
+            raise TypeError(f'Unknown buffer options {unknown}')
+        table_options = self._table_buffer_options.setdefault(table, {})
+        table_options.update(options)
+        if table_options.get('aggregate') is not None or table_options.get('partition') is not None:
+            self._row_tables.add(table)
+        else:
+            self._row_tables.discard(table)
+        return self
+
+    def discover(self, table, records=None, columns=None, **kwargs):
+        return TableDiscovery(table=table, ch=self, records=records, columns=columns, **kwargs)
+
+    def sharded(self, table, sharding_key, shards=None, cluster=None, **options):
+        """
+        Returns ShardRouter, that writes rows directly to local `table` of every shard
+        """
+        return ShardRouter(self, table, sharding_key, shards=shards, cluster=cluster, **options)
 
     def flush(self, table):
         pass
@@ -144,6 +327,8 @@ class BaseClickHouse():
         """
         Add document to upload chunk
         """
+        if self._row_tables and self._push_rows(table, (doc,)):
+            return
         if jsonDump == True:
             try:
                 doc = ujson.dumps(doc, ensure_ascii=False)
@@ -151,14 +336,136 @@ class BaseClickHouse():
                 logger.exception('exc during push')
                 raise e
 
-        self._buffer[table].append(doc)
-        if self._buffer[table].full:
-            self.flush(table)
+        if self._serializing.get(table):
+            # rows serialized by executor should be written first
+            ready = Future()
+            ready.set_result(((doc + '\n').encode(), 1))
+            self._enqueue_serialized(table, ready)
+            return
+
+        with self._lock:
+            buff = self._buffer[table]
+            buff.append(doc)
+            due = buff.due()
+        if due:
+            self._request_flush(table)
+
+    def push_many(self, table, docs, jsonDump=True):
+        """
+        Add list of documents. Documents are serialized in one pass and written
+        to buffer by chunks, limits are checked once per chunk.
+        With `serialize_executor` chunks are serialized by executor
+        """
+        if self._row_tables and self._push_rows(table, docs):
+            return
+        if self._serializer and jsonDump == True:
+            self._submit_serialize(table, list(docs))
+            return
+        if jsonDump == True:
+            dumps = ujson.dumps
+            docs = [dumps(doc, ensure_ascii=False) for doc in docs]
+        elif not isinstance(docs, list):
+            docs = list(docs)
+        if docs and self._serializing.get(table):
+            # rows serialized by executor should be written first
+            ready = Future()
+            ready.set_result(('\n'.join(docs + ['']).encode(), len(docs)))
+            self._enqueue_serialized(table, ready)
+            return
+        pos = 0
+        while pos < len(docs):
+            with self._lock:
+                buff = self._buffer[table]
+                end = pos + buff.capacity
+                buff.append_many(docs[pos:end])
+                due = buff.due()
+            if due:
+                self._request_flush(table)
+            pos = end
+
+    def _push_rows(self, table, docs):
+        """
+        Adds documents to buffer of table taking rows (aggregating or partitioned).
+        Returns False if buffer takes serialized documents
+        """
+        if self._serializing.get(table):
+            # rows serialized by executor should be written first
+            self._collect_serialized(table, limit=0)
+        with self._lock:
+            buff = self._buffer[table]
+            if not buff.by_rows:
+                return False
+            for doc in docs:
+                buff.add(doc)
+            due = buff.due()
+        if due:
+            self._request_flush(table)
+        return True
+
+    def _submit_serialize(self, table, docs):
+        pos = 0
+        size = self._buffer[table].capacity
+        while pos < len(docs):
+            future = self._serializer.submit(serialize_rows, docs[pos:pos + size])
+            self._enqueue_serialized(table, future)
+            pos += size
+            size = self._buffer[table].buffer_limit
+
+    def _enqueue_serialized(self, table, future):
+        with self._serial_lock:
+            self._serializing.setdefault(table, deque()).append(future)
+        self._collect_serialized(table, limit=self.SERIALIZE_QUEUE)
+
+    def _collect_serialized(self, table, limit=None):
+        """
+        Writes encoded chunks to buffer in order they were submitted.
+        Waits for chunks while more than `limit` of them are pending
+        """
+        while True:
+            with self._serial_lock:
+                queue = self._serializing.get(table)
+                if not queue or not (queue[0].done() or (limit is not None and len(queue) > limit)):
+                    return
+                data, count = queue.popleft().result()
+                with self._lock:
+                    buff = self._buffer[table]
+                    buff.write(data, count=count)
+                    due = buff.due()
+            if due:
+                self._request_flush(table)
+
+    def _tables(self):
+        return list(dict.fromkeys([*self._buffer, *self._serializing]))
+
+    def _request_flush(self, table):
+        self._flush_buffer(table, due_only=True)
+
+    def _take_buffers(self, table, due_only=False):
+        """
+        Takes buffers of table to write: whole buffer, replaced by new one,
+        or (due only) partitions of partitioned buffer
+        """
+        with self._lock:
+            buff = self._buffer.get(table)
+            if not buff or not len(buff):
+                return []
+            if buff.partitioned:
+                return buff.pop_parts(due_only=due_only)
+            self._buffer[table] = self._create_buffer(table)
+            return [buff]
 
     def flush_all(self):
-        for k in self._buffer:
+        for k in self._tables():
             self.flush(k)
 
+    def flush_due(self):
+        """
+        Flush only tables which buffers are full or too old
+        """
+        now = monotonic()
+        return [self._flush_buffer(k, due_only=True) if buff.partitioned else self.flush(k)
+                for k, buff in list(self._buffer.items()) if buff.due(now)]
+
     @staticmethod
     def set_debug(level=logging.DEBUG):
         logger.setLevel(level)
@@ -173,104 +480,536 @@ class AsyncClickHouse(BaseClickHouse):
             self.loop = asyncio.get_event_loop()
         self._flush_timer = asyncio.ensure_future(self._timer(), loop=self.loop)
         self.conn_class = aiohttp.ClientSession
+        self._session = None
+        # batches in flight -> payload size
+        self._batches = {}
+        # batches scheduled, but not yet sending -> buffer
+        self._waiting = OrderedDict()
+        # batches dropped by overflow policy before sending
+        self._dropped = set()
+        self._pending_bytes = 0
+        self._capacity = asyncio.Event()
+        self._inflight = asyncio.Semaphore(self.max_inflight) if self.max_inflight else None
+        self._table_inflight = {}
+        self._replay_timer = None
+        if self._spool is not None:
+            self._replay_timer = asyncio.ensure_future(self._replayer(), loop=self.loop)
+        self._health_timer = None
+        if len(self._balancer) > 1:
+            self._health_timer = asyncio.ensure_future(self._health_checker(), loop=self.loop)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
 
     async def _timer(self):
         while True:
-            await asyncio.sleep(self.flush_every)
-            self.flush_all()
+            await asyncio.sleep(self.flush_interval)
+            self.flush_due()
+
+    async def _replayer(self):
+        while True:
+            await asyncio.sleep(self.replay_interval)
+            try:
+                await self.replay_spool()
+            except Exception:
+                logger.exception('spool replay failed')
+
+    async def _health_checker(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            await self.check_hosts()
+
+    async def check_hosts(self):
+        """
+        Pings every host, unavailable ones are excluded from balancing.
+        Returns dict host -> availability
+        """
+        hosts = self._balancer.hosts
+        results = await asyncio.gather(*[self.ping(host) for host in hosts])
+        return {host.base_url: ok for host, ok in zip(hosts, results)}
+
+    async def replay_spool(self):
+        """
+        Sends batches saved in spool, if server is available.
+        Returns number of written batches
+        """
+        if self._spool is None or not self._spool.entries() or not await self.ping():
+            return 0
+        replayed = 0
+        for name in self._spool.entries():
+            query, headers, payload = self._spool.load(name)
+            try:
+                with payload:
+                    await self._insert(query, payload, headers, retry=RetryPolicy.create(None))
+            except Exception:
+                if await self.ping():
+                    self._spool.mark_failed(name)
+                    continue
+                logger.warning('server is unavailable, spool replay postponed')
+                break
+            self._spool.remove(name)
+            replayed += 1
+        return replayed
+
+    async def ping(self, host=None):
+        """
+        Checks server (or given host of balancer) is available
+        """
+        session = self._get_session()
+        try:
+            async with self._request(session, 'get', '/ping', hosts=host and [host]) as response:
+                ok = response.status == 200
+        except Exception:
+            logger.debug('ping failed', exc_info=True)
+            ok = False
+        if not ok and host:
+            self._balancer.mark_down(host)
+        return ok
+
+    def _get_session(self):
+        """
+        Returns shared session. Session is created lazily because connector
+        should be created inside running loop
+        """
+        if self._session is None or getattr(self._session, 'closed', False):
+            connector = aiohttp.TCPConnector(
+                limit=self._pool_size,
+                limit_per_host=self._pool_size_per_host,
+                keepalive_timeout=self._pool_idle_timeout,
+                use_dns_cache=self._dns_cache_ttl is not None,
+                ttl_dns_cache=self._dns_cache_ttl)
+            self._session = self.conn_class(connector=connector)
+        return self._session
 
     def close(self):
-        if self._flush_timer:
-            self._flush_timer.cancel()
+        """
+        Stops flush timer, flushes buffers and closes session.
+        Returns future, that can be awaited to wait graceful shutdown
+        """
+        for timer in (self._flush_timer, self._replay_timer, self._health_timer):
+            if timer:
+                timer.cancel()
+        self._flush_timer = self._replay_timer = self._health_timer = None
+        return asyncio.ensure_future(self._close(), loop=self.loop)
+
+    async def _close(self):
+        await self.flush_all()
+        if self._batches:
+            await asyncio.gather(*list(self._batches), return_exceptions=True)
+        session, self._session = self._session, None
+        if session is not None:
+            await session.close()
+
+    @property
+    def pending_bytes(self):
+        return self._pending_bytes
+
+    def _overloaded(self):
+        if self.max_pending_bytes and self._pending_bytes >= self.max_pending_bytes:
+            return True
+        # all slots are busy and some batches are waiting
+        return bool(self._waiting)
+
+    async def drain(self):
+        """
+        Waits until inserts in flight fit limits. Use after `push` for backpressure
+        """
+        while self._overloaded():
+            self._capacity.clear()
+            await self._capacity.wait()
 
     def flush(self, table):
         """
         Flush buffer of table
         """
-        buff = self._buffer.get(table)
-        if buff and len(buff):
-            return asyncio.ensure_future(self._flush(table, buff))
-               
-    async def _flush(self, table, buff: io.BytesIO):
+        if self._serializing.get(table):
+            return asyncio.ensure_future(self._flush_serialized(table), loop=self.loop)
+        return self._flush_buffer(table)
+
+    async def _flush_serialized(self, table):
+        await asyncio.gather(*[asyncio.wrap_future(f, loop=self.loop) for f in list(self._serializing[table])])
+        self._collect_serialized(table)
+        result = self.flush(table)
+        if result is not None:
+            return await result
+
+    def _enqueue_serialized(self, table, future):
+        super()._enqueue_serialized(table, future)
+        if not future.done():
+            future.add_done_callback(lambda _: self.loop.call_soon_threadsafe(self._collect_ready, table))
+
+    def _collect_ready(self, table):
+        try:
+            self._collect_serialized(table)
+        except Exception:
+            logger.exception('serialization failed')
+
+    def _flush_buffer(self, table, due_only=False):
+        buffers = self._take_buffers(table, due_only)
+        for buff in buffers:
+            buff.prepare()
+        if len(buffers) == 1:
+            return self._schedule(table, buffers[0])
+        if buffers:
+            return asyncio.gather(*[self._schedule(table, buff) for buff in buffers])
+
+    def _schedule(self, table, buff):
+        if (self.overflow == OVERFLOW_SPILL and self._spool is not None and self.max_pending_bytes
+                and self._pending_bytes + buff.payload_size > self.max_pending_bytes):
+            logger.warning('too many pending inserts, saving batch to spool')
+            saved = self.loop.run_in_executor(None, self._spool.save, insert_query(table, buff), buff.buffer, buff.headers)
+            saved.add_done_callback(lambda _: buff.close())
+            return saved
+        task = asyncio.ensure_future(self._send_batch(table, buff), loop=self.loop)
+        self._batches[task] = buff.payload_size
+        self._pending_bytes += buff.payload_size
+        self._waiting[task] = buff
+        # callback is called even if task was cancelled before start
+        task.add_done_callback(self._release_batch)
+        if self.overflow == OVERFLOW_DROP_OLDEST:
+            while self.max_pending_bytes and self._pending_bytes > self.max_pending_bytes and len(self._waiting) > 1:
+                oldest, dropped = self._waiting.popitem(last=False)
+                logger.warning('too many pending inserts, dropping batch')
+                # task is not cancelled: it is awaited by flush callers, it finishes without sending
+                self._dropped.add(oldest)
+                dropped.close()
+                self._release_batch(oldest)
+        return task
+
+    def _release_batch(self, task):
+        self._waiting.pop(task, None)
+        self._pending_bytes -= self._batches.pop(task, 0)
+        self._capacity.set()
+
+    def _semaphores(self, table):
+        sems = []
+        if self.max_inflight:
+            sems.append(self._inflight)
+        if self.max_inflight_per_table:
+            if table not in self._table_inflight:
+                self._table_inflight[table] = asyncio.Semaphore(self.max_inflight_per_table)
+            sems.append(self._table_inflight[table])
+        return sems
+
+    async def _send_batch(self, table, buff):
+        task = asyncio.current_task()
+        acquired = []
+        try:
+            for sem in self._semaphores(table):
+                if task in self._dropped:
+                    break
+                await sem.acquire()
+                acquired.append(sem)
+            if task in self._dropped:
+                self._dropped.discard(task)
+                return
+            self._waiting.pop(task, None)
+            return await self._flush(table, buff)
+        finally:
+            for sem in acquired:
+                sem.release()
+
+    async def _flush(self, table, buff):
         """
-        Flushing buffer to DB
+        Flushing buffer to DB. Failed batch is saved to spool if configured
         """
+        sql_query = insert_query(table, buff)
+        logger.debug(f'flushing table {table} query {sql_query}')
         try:
-            sql_query = f'INSERT INTO {table} FORMAT JSONEachRow'
-            logger.debug(f'flushing table {table} query {sql_query}')
-            if buff and len(self._buffer[table]):
-                self._buffer[table].prepare()
-                self._buffer[table] = Buffer()
-                resp_data = await self.run(sql_query, data=buff.buffer)
-                return resp_data
-        except Exception:
+            return await self._insert(sql_query, buff.buffer, buff.headers)
+        except Exception as e:
             logger.exception('ch ex')
+            # batch rejected by server would be rejected again
+            if self._spool is not None and is_transient(e):
+                await self.loop.run_in_executor(None, self._spool.save, sql_query, buff.buffer, buff.headers)
+        finally:
+            buff.close()
+
+    async def _insert(self, sql_query, body, headers=None, retry=None):
+        """
+        Sends insert payload, retrying according to retry policy
+        """
+        start = body.tell()
+        delays = (retry or self.retry).delays()
+        while True:
+            body.seek(start)
+            try:
+                session = self._get_session()
+                async with self._make_request(sql_query, session, body=body, method='POST', headers=headers) as response:
+                    if response.status != 200:
+                        raise ClickHouseHTTPError(response.status, await response.text())
+                    result = bytes_decoder(await response.read())
+                    if result != '':
+                        return result
+                    return
+            except Exception as e:
+                delay = next(delays, None) if is_transient(e) else None
+                if delay is None:
+                    raise
+                logger.warning('insert failed, retry in %.2f s', delay, exc_info=True)
+                await asyncio.sleep(delay)
 
     def flush_all(self):
         tasks = []
-        for k in self._buffer:
+        for k in self._tables():
             fut = self.flush(k)
             if fut:
                 tasks.append(fut)
         return asyncio.gather(*tasks)
+
+    def flush_due(self):
+        return asyncio.gather(*[fut for fut in super().flush_due() if fut])
      
-    async def run(self, sql_query, data=None, decoder=bytes_decoder):
+    async def run(self, sql_query, data=None, decoder=bytes_decoder, headers=None):
         """
         Executes SQL code
         """
-        async with self.conn_class() as session:
-            async with self._make_request(sql_query, session, body=data, method='POST') as response:
-                logger.debug(f'respopnse with status code = {response.status}')
-                if response.status == 200:
-                    result = decoder(await response.read())
-                    if result != '':
-                        return result
-                else:
-                    logger.error('wrong http code %s %s', response.status, await response.text())
+        session = self._get_session()
+        async with self._make_request(sql_query, session, body=data, method='POST', headers=headers) as response:
+            logger.debug(f'respopnse with status code = {response.status}')
+            if response.status == 200:
+                result = decoder(await response.read())
+                if result != '':
+                    return result
+            else:
+                logger.error('wrong http code %s %s', response.status, await response.text())
 
     async def select(self, sql_query, decoder=bytes_decoder):
-        async with self.conn_class() as session:
-            async with self._make_request(sql_query, session) as response:
-                logger.debug(f'respopnse with status code = {response.status}')
-                if response.status == 200:
-                    return decoder(await response.read())
-                else:
-                    logger.error('wrong http code %s %s', response.status, await response.text())
-
-    async def objects_stream(self, sql_query, decoder=json_decoder, format=JSONEACHROW):
-        async with self.conn_class() as session:
-            async with self._make_request(sql_query + format_format(format), session) as response:
-                logger.debug(f'respopnse with status code = {response.status}')
-                if response.status == 200:
-                    async for line in response.content:
-                        if line:
-                            yield decoder(line)
-                else:
-                    logger.error('wrong http code %s %s', response.status, await response.text())
+        session = self._get_session()
+        async with self._make_request(sql_query, session) as response:
+            logger.debug(f'respopnse with status code = {response.status}')
+            if response.status == 200:
+                return decoder(await response.read())
+            else:
+                logger.error('wrong http code %s %s', response.status, await response.text())
+
+    async def objects_stream(self, sql_query, decoder=json_decoder, format=JSONEACHROW, external=None):
+        """
+        Streams decoded rows. `external` - list of `ExternalTable` sent along with query
+        """
+        params, body, headers = encode_external(external) if external else (None, None, None)
+        session = self._get_session()
+        async with self._make_request(
+                sql_query + format_format(format), session, body=body, headers=headers, params=params) as response:
+            logger.debug(f'respopnse with status code = {response.status}')
+            if response.status == 200:
+                async for line in response.content:
+                    if line:
+                        yield decoder(line)
+            else:
+                logger.error('wrong http code %s %s', response.status, await response.text())
+
+    async def rows_stream(self, sql_query, format=ROWBINARY_WITH_NAMES_AND_TYPES, columns=None, as_dict=False):
+        """
+        Streams rows decoded from binary format as tuples (or dicts if `as_dict`).
+        For `RowBinary` format `columns` types should be provided
+        """
+        decoder = RowBinaryDecoder(columns=columns, as_dict=as_dict)
+        session = self._get_session()
+        async with self._make_request(sql_query + format_format(format), session) as response:
+            logger.debug(f'respopnse with status code = {response.status}')
+            if response.status == 200:
+                async for chunk in response.content.iter_any():
+                    for row in decoder.feed(chunk):
+                        yield row
+                decoder.close()
+            else:
+                logger.error('wrong http code %s %s', response.status, await response.text())
+
+    async def select_columns(self, sql_query):
+        """
+        Returns dict column name -> numpy array. Requires numpy
+        """
+        decoder = ColumnarDecoder()
+        session = self._get_session()
+        async with self._make_request(sql_query + format_format(ROWBINARY_WITH_NAMES_AND_TYPES), session) as response:
+            logger.debug(f'respopnse with status code = {response.status}')
+            if response.status == 200:
+                async for chunk in response.content.iter_any():
+                    decoder.feed(chunk)
+                return decoder.result()
+            else:
+                logger.error('wrong http code %s %s', response.status, await response.text())
 
     def _make_request(self,
                       sql_query,
                       session,
                       body=None,
-                      method=None):
+                      method=None,
+                      headers=None,
+                      params=None):
         if not method:
             method = 'post' if body else 'get'
+        if self.response_compression:
+            # aiohttp decompresses gzip / deflate response by itself while streaming
+            headers = {**(headers or {}), 'Accept-Encoding': self.response_compression}
         logger.debug(
-            f"Making query to {self.base_url} with %s. timeout:{self._timeout}", self._build_params(sql_query))
-        return session.request(
+            f"Making query with %s. timeout:{self._timeout}", self._build_params(sql_query))
+        return self._request(
+            session,
             method,
-            url=self.scheme + '://' + self.base_url,
-            timeout=self._timeout,
-            params=self._build_params(sql_query),
-            data=body, chunked=True)
+            params={**self._build_params(sql_query), **(params or {})},
+            headers=headers,
+            # chunked without body leaves garbage in keep-alive connection
+            data=body, chunked=True if body is not None else None)
+
+    @asynccontextmanager
+    async def _request(self, session, method, path='', hosts=None, **kwargs):
+        """
+        Sends request to host chosen by balancer. If host can't be connected,
+        it is marked down and request is sent to the next one
+        """
+        candidates = hosts or self._balancer.candidates()
+        for i, host in enumerate(candidates):
+            request = session.request(
+                method, url=f'{self.scheme}://{host.base_url}{path}', timeout=self._timeout, **kwargs)
+            started = monotonic()
+            try:
+                response = await request.__aenter__()
+            except aiohttp.ClientConnectorError:
+                self._balancer.mark_down(host)
+                if i == len(candidates) - 1:
+                    raise
+                logger.warning('host %s is unavailable, trying next one', host.base_url)
+                continue
+            self._balancer.report(host, monotonic() - started)
+            try:
+                yield response
+            finally:
+                await request.__aexit__(None, None, None)
+            return
 
 
 class ClickHouse(BaseClickHouse):
 
+    # Errors of reused keep-alive connection closed by server in between requests
+    STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+    SERIALIZE_QUEUE = 16
+
     def _init(self):
         self.conn_class = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        self._pools = {
+            host.base_url: ConnectionPool(
+                partial(self._connect, host.base_url),
+                maxsize=self._pool_size,
+                idle_timeout=self._pool_idle_timeout,
+                timeout=self._timeout)
+            for host in self._balancer.hosts}
+        self._pool = self._pools[self.base_url]
+        self._closed = False
+        self._flusher = None
+        if self._flush_thread or self._spool is not None or len(self._balancer) > 1:
+            self._wakeup = threading.Event()
+            self._flusher = threading.Thread(target=self._flusher_loop, name='simplech-flusher', daemon=True)
+            self._flusher.start()
+            atexit.register(self.close)
+
+    def _flusher_loop(self):
+        last_replay = last_check = monotonic()
+        intervals = [self.flush_interval if self._flush_thread else None,
+                     self.replay_interval if self._spool is not None else None,
+                     self.health_check_interval if len(self._balancer) > 1 else None]
+        tick = min(i for i in intervals if i is not None)
+        while not self._closed:
+            self._wakeup.wait(tick)
+            self._wakeup.clear()
+            if self._closed:
+                break
+            try:
+                if self._flush_thread:
+                    self.flush_due()
+                now = monotonic()
+                if self._spool is not None and now - last_replay >= self.replay_interval:
+                    last_replay = now
+                    self.replay_spool()
+                if len(self._balancer) > 1 and now - last_check >= self.health_check_interval:
+                    last_check = now
+                    self.check_hosts()
+            except Exception:
+                logger.exception('background flush failed')
+
+    def check_hosts(self):
+        """
+        Pings every host, unavailable ones are excluded from balancing.
+        Returns dict host -> availability
+        """
+        return {host.base_url: self.ping(host) for host in self._balancer.hosts}
+
+    def replay_spool(self):
+        """
+        Sends batches saved in spool, if server is available.
+        Returns number of written batches
+        """
+        if self._spool is None or not self._spool.entries() or not self.ping():
+            return 0
+        replayed = 0
+        for name in self._spool.entries():
+            query, headers, payload = self._spool.load(name)
+            try:
+                with payload:
+                    self._insert(query, payload, headers, retry=RetryPolicy.create(None))
+            except Exception:
+                if self.ping():
+                    self._spool.mark_failed(name)
+                    continue
+                logger.warning('server is unavailable, spool replay postponed')
+                break
+            self._spool.remove(name)
+            replayed += 1
+        return replayed
+
+    def ping(self, host=None):
+        """
+        Checks server (or given host of balancer) is available
+        """
+        try:
+            pool, conn, response = self._send('GET', '/ping', hosts=host and [host])
+            ok = response.status == 200
+            self._finish(pool, conn, response)
+        except Exception:
+            logger.debug('ping failed', exc_info=True)
+            ok = False
+        if not ok and host:
+            self._balancer.mark_down(host)
+        return ok
+
+    def _request_flush(self, table):
+        if self._flush_thread:
+            # network io is done by flusher thread, not by producer
+            self._wakeup.set()
+        else:
+            self._flush_buffer(table, due_only=True)
+
+    def _connect(self, base_url):
+        logger.debug('Conn base url: %s', base_url)
+        conn = self.conn_class(base_url, timeout=self._timeout)
+        if logger.level == logging.DEBUG:
+            conn.set_debuglevel(logger.level)
+        return conn
+
+    def close(self):
+        """
+        Stops background flusher, writes all buffers and closes connections
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._flusher:
+            atexit.unregister(self.close)
+            self._wakeup.set()
+            self._flusher.join()
+        try:
+            self.flush_all()
+        finally:
+            for pool in self._pools.values():
+                pool.close()
 
     def table(self, table, **options):
+        for key in ('compression', 'backend', 'directory'):
+            options.setdefault(key, self._buffer_options[key])
         return WriterContext(ch=self, table=table, **options)
 
     def flush(self, table):
@@ -278,67 +1017,191 @@ class ClickHouse(BaseClickHouse):
         Flushing buffer to DB
         """
         logger.debug('called flush')
-        buff = self._buffer.get(table)
-        if buff and len(buff):
+        self._collect_serialized(table, limit=0)
+        return self._flush_buffer(table)
+
+    def _flush_buffer(self, table, due_only=False):
+        result = error = None
+        # every partition is written even if previous one failed
+        for buff in self._take_buffers(table, due_only):
             buff.prepare()
-            result = self._flush(table, buff)
-            self._buffer[table] = Buffer()
-            return result
+            try:
+                result = self._flush(table, buff)
+            except Exception as e:
+                error = error or e
+        if error:
+            raise error
+        return result
 
     def _flush(self, table, buff: io.BytesIO):
-        sql_query = f'INSERT INTO {table} FORMAT JSONEachRow'
+        """
+        Writes buffer to DB. Failed batch is saved to spool if configured, otherwise exception is raised
+        """
+        sql_query = insert_query(table, buff)
         logger.debug(f'flushing table {table} query {sql_query}')
-        result = self._make_request(sql_query, body=buff.buffer, method='POST')
-        if result.code != 200:
-            return result
-        if result != '':
-            return result
+        try:
+            return self._insert(sql_query, buff.buffer, buff.headers)
+        except Exception as e:
+            # batch rejected by server would be rejected again
+            if self._spool is None or not is_transient(e):
+                raise
+            logger.exception('insert failed')
+            self._spool.save(sql_query, buff.buffer, buff.headers)
+        finally:
+            buff.close()
+
+    def _insert(self, sql_query, body, headers=None, retry=None):
+        """
+        Sends insert payload, retrying according to retry policy
+        """
+        start = body.tell()
+        delays = (retry or self.retry).delays()
+        while True:
+            body.seek(start)
+            try:
+                with self._make_request(sql_query, body=body, method='POST', headers=headers) as response:
+                    result = bytes_decoder(response.read())
+                if result != '':
+                    return result
+                return
+            except Exception as e:
+                delay = next(delays, None) if is_transient(e) else None
+                if delay is None:
+                    raise
+                logger.warning('insert failed, retry in %.2f s', delay, exc_info=True)
+                sleep(delay)
 
     def run(self, sql_query, data=None, decoder=bytes_decoder):
         if data:
             data = data.encode('utf-8')
-        response = self._make_request(sql_query, body=data, method='POST')
-        if response.code != 200:
-            return response
-        result = decoder(response.read())
+        with self._make_request(sql_query, body=data, method='POST') as response:
+            result = decoder(response.read())
         if result != '':
             return result
 
     def select(self, sql_query, decoder=bytes_decoder):
-        response = self._make_request(sql_query)
-        return decoder(response.read())
+        with self._make_request(sql_query) as response:
+            return decoder(response.read())
 
-    def objects_stream(self, sql_query, decoder=json_decoder, format=JSONEACHROW):
-        response = self._make_request(sql_query + format_format(format))
-        while True:
-            line = response.readline()
-            if line:
-                yield decoder(line)
-            else:
-                break
+    def objects_stream(self, sql_query, decoder=json_decoder, format=JSONEACHROW, external=None):
+        """
+        Streams decoded rows. `external` - list of `ExternalTable` sent along with query
+        """
+        params, body, headers = encode_external(external) if external else (None, None, None)
+        with self._make_request(sql_query + format_format(format), body=body, headers=headers, params=params) as response:
+            while True:
+                line = response.readline()
+                if line:
+                    yield decoder(line)
+                else:
+                    break
+
+    def rows_stream(self, sql_query, format=ROWBINARY_WITH_NAMES_AND_TYPES, columns=None, as_dict=False):
+        """
+        Streams rows decoded from binary format as tuples (or dicts if `as_dict`).
+        For `RowBinary` format `columns` types should be provided
+        """
+        decoder = RowBinaryDecoder(columns=columns, as_dict=as_dict)
+        with self._make_request(sql_query + format_format(format)) as response:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield from decoder.feed(chunk)
+        decoder.close()
 
-    def _make_request(self, sql_query, body=None, method=None):
-        logger.debug('Conn base url: %s', self.base_url)
-        conn = self.conn_class(self.base_url)
+    def select_columns(self, sql_query):
+        """
+        Returns dict column name -> numpy array. Requires numpy
+        """
+        decoder = ColumnarDecoder()
+        with self._make_request(sql_query + format_format(ROWBINARY_WITH_NAMES_AND_TYPES)) as response:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                decoder.feed(chunk)
+        return decoder.result()
 
-        if logger.level == logging.DEBUG:
-            conn.set_debuglevel(logger.level)
+    def _send(self, method, url, body=None, headers=None, hosts=None):
+        """
+        Sends request using pooled connection to host chosen by balancer.
+        Request which failed on reused connection repeated once using fresh one.
+        If host can't be connected, it is marked down and the next one is used.
+        Returns (pool, connection, response)
+        """
+        start = body.tell() if hasattr(body, 'tell') else None
+        candidates = hosts or self._balancer.candidates()
+        for i, host in enumerate(candidates):
+            pool = self._pools[host.base_url]
+            while True:
+                conn, reused = pool.acquire()
+                if getattr(conn, 'sock', None) is None:
+                    try:
+                        conn.connect()
+                    except BaseException as e:
+                        pool.discard(conn)
+                        if not isinstance(e, OSError):
+                            raise
+                        self._balancer.mark_down(host)
+                        if i == len(candidates) - 1:
+                            raise
+                        logger.warning('host %s is unavailable, trying next one', host.base_url)
+                        break
+                started = monotonic()
+                try:
+                    conn.request(method, url, body=body, headers=headers or {})
+                    response = conn.getresponse()
+                except self.STALE_CONNECTION_ERRORS:
+                    pool.discard(conn)
+                    if not reused:
+                        raise
+                    logger.debug('reused connection closed by server, retrying')
+                    if start is not None:
+                        body.seek(start)
+                    continue
+                except BaseException:
+                    pool.discard(conn)
+                    raise
+                self._balancer.report(host, monotonic() - started)
+                return pool, conn, response
 
+    @contextmanager
+    def _make_request(self, sql_query, body=None, method=None, headers=None, params=None):
         query_str = urllib.parse.urlencode(
-            self._build_params(sql_query), encoding='utf-8')
+            {**self._build_params(sql_query), **(params or {})}, encoding='utf-8')
         logger.debug('Query string: %s', query_str)
 
         if not method:
             method = 'POST' if body else 'GET'
+        if self.response_compression:
+            headers = {**(headers or {}), 'Accept-Encoding': self.response_compression}
 
-        conn.request(method, f"/?{query_str}", body=body)
-        response = conn.getresponse()
+        pool, conn, response = self._send(method, f"/?{query_str}", body=body, headers=headers)
+        encoding = response.getheader('Content-Encoding')
+        if encoding in DECOMPRESSORS:
+            response = DecompressingReader(response, encoding, chunk_size=CHUNK_SIZE)
 
         if response.status != 200:
             content = response.read()
+            pool.discard(conn)
             logger.error('Wrong HTTP statusCode %s. Return: %s',
                          response.status, content)
-            raise Exception(f'ClickHouse HTTP Error')
+            raise ClickHouseHTTPError(response.status, content.decode(errors='replace'))
         logger.debug(
             f'Server response status: {response.status}, content-length: {response.length}')
-        return response
+        try:
+            yield response
+        except BaseException:
+            pool.discard(conn)
+            raise
+        self._finish(pool, conn, response)
+
+    def _finish(self, pool, conn, response):
+        # Connection can be reused only when response was read completely
+        if not response.isclosed():
+            response.read()
+        if not response.will_close:
+            pool.release(conn)
+        else:
+            pool.discard(conn)
@@ -0,0 +1,66 @@
+import os
+import shutil
+import ujson
+from itertools import count
+from time import time
+from .log import logger
+
+
+class Spool:
+    """
+    Directory with insert batches, that were not written to DB.
+    Every batch is stored as ready to send payload (possibly compressed)
+    with query and http headers, and can be replayed later.
+    """
+
+    SUFFIX = '.batch'
+    FAILED_SUFFIX = '.failed'
+
+    def __init__(self, path):
+        self.path = path
+        self._counter = count()
+        os.makedirs(path, exist_ok=True)
+
+    def __len__(self):
+        return len(self.entries())
+
+    def entries(self):
+        return sorted(f for f in os.listdir(self.path) if f.endswith(self.SUFFIX))
+
+    def save(self, query, payload, headers=None):
+        """
+        Writes batch. `payload` is bytes or file-like object
+        """
+        name = f'{int(time() * 1000000)}-{os.getpid()}-{next(self._counter)}{self.SUFFIX}'
+        target = os.path.join(self.path, name)
+        tmp = target + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(ujson.dumps({'query': query, 'headers': headers or {}}).encode() + b'\n')
+            if isinstance(payload, (bytes, bytearray)):
+                f.write(payload)
+            else:
+                payload.seek(0)
+                shutil.copyfileobj(payload, f)
+        # rename is atomic, so replayer never sees partially written batch
+        os.replace(tmp, target)
+        logger.warning('batch saved to spool %s', target)
+        return name
+
+    def load(self, name):
+        """
+        Returns (query, headers, opened payload file)
+        """
+        f = open(os.path.join(self.path, name), 'rb')
+        meta = ujson.loads(f.readline())
+        return meta['query'], meta['headers'], f
+
+    def remove(self, name):
+        os.remove(os.path.join(self.path, name))
+
+    def mark_failed(self, name):
+        """
+        Batch rejected by healthy server should not block others
+        """
+        path = os.path.join(self.path, name)
+        os.replace(path, path[:-len(self.SUFFIX)] + self.FAILED_SUFFIX)
+        logger.error('batch %s rejected by server, marked as failed', name)
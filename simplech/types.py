@@ -1,4 +1,5 @@
 from typing import NewType
+import datetime
 
 
 class UInt64(int):
@@ -83,6 +84,15 @@ class Float32(float):
     """
 
 
+PYTOCH_MAP = {
+    str: String,
+    float: Float64,
+    int: Int64,
+    datetime.date: Date,
+    datetime.datetime: DateTime
+}
+
+
 TYPES_PRIORITY = {
     'String': 13,
     'Float64': 12,
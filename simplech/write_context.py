@@ -1,34 +1,310 @@
 import io
+import datetime
 import ujson
+import tempfile
+from time import monotonic
 from .log import logger 
+from .rowbinary import RowBinaryEncoder, ROWBINARY, type_name, to_days, to_timestamp, EPOCH_ORDINAL
+from .compression import get_compressor, resolve_method
+from .encoder import compile_json_encoder, to_int, to_float
+
+
+BACKEND_MEMORY = 'memory'
+BACKEND_FILE = 'file'
+
 
 class Buffer:
-    def __init__(self, buffer_limit=5000):
+    """
+    Flush policy: buffer is full when `buffer_limit` rows or `bytes_limit` bytes
+    (uncompressed) collected, and is due to flush when full or `max_age` seconds
+    passed since first row.
+
+    compression: compress data while appending, `gzip`, `deflate`, `zstd`, `lz4`
+        or `True` for best available
+    backend: `memory` keeps data in BytesIO, `file` in anonymous temporary file
+        (in `directory`), that is streamed to server on flush. Use it for big batches
+    """
+
+    # takes rows (dicts) by `add`
+    by_rows = False
+    aggregating = False
+    partitioned = False
+
+    def __init__(self, buffer_limit=5000, format='JSONEachRow', columns=None, compression=None, bytes_limit=None, max_age=None,
+                 backend=BACKEND_MEMORY, directory=None):
         self.buffer_limit = buffer_limit
-        self.buffer = io.BytesIO()
+        self.bytes_limit = bytes_limit
+        self.max_age = max_age
+        if backend == BACKEND_FILE:
+            # removed by OS when closed, pages are kept in page cache, not in heap
+            self.buffer = tempfile.TemporaryFile(prefix='simplech-', dir=directory)
+        elif backend == BACKEND_MEMORY:
+            self.buffer = io.BytesIO()
+        else:
+            raise ValueError(f'Unknown buffer backend {backend}')
+        self.backend = backend
         self.counter = 0
+        self.size = 0
+        self.payload_size = 0
+        self.created = None
         self.full = False
+        self.format = format
+        self.columns = columns
+        self.compression = resolve_method(compression)
+        self._compressor = get_compressor(self.compression) if self.compression else None
 
     def __len__(self):
         return self.counter
 
+    @property
+    def headers(self):
+        if self.compression:
+            return {'Content-Encoding': self.compression}
+        return {}
+
+    @property
+    def age(self):
+        return monotonic() - self.created if self.counter else 0
+
+    def due(self, now=None):
+        if self.full:
+            return True
+        if self.max_age is None or not self.counter:
+            return False
+        return (now or monotonic()) - self.created >= self.max_age
+
     def prepare(self):
+        if self._compressor:
+            self.buffer.write(self._compressor.flush())
+            self._compressor = None
+        self.payload_size = self.buffer.seek(0, io.SEEK_END)
         self.buffer.seek(0)
 
+    def close(self):
+        self.buffer.close()
+
     def append(self, rec):
-        self.buffer.write((rec + '\n').encode())
-        self.counter += 1
-        if self.counter >= self.buffer_limit:
+        self.write((rec + '\n').encode())
+
+    def append_many(self, recs):
+        """
+        Append list of serialized rows as one chunk
+        """
+        self.write('\n'.join(recs + ['']).encode(), count=len(recs))
+
+    @property
+    def capacity(self):
+        """
+        Rows left before buffer is full, at least 1
+        """
+        return max(1, self.buffer_limit - self.counter)
+
+    def write(self, data, count=1):
+        """
+        Append already encoded rows
+        """
+        if not self.counter:
+            self.created = monotonic()
+        self.size += len(data)
+        if self._compressor:
+            data = self._compressor.compress(data)
+        self.buffer.write(data)
+        self.counter += count
+        if self.counter >= self.buffer_limit or (self.bytes_limit and self.size >= self.bytes_limit):
             self.full = True
 
 
+class AggregatingBuffer(Buffer):
+    """
+    Sums metrics of rows with the same dimensions of `discovery` (TableDiscovery)
+    until flush, then sends one row per dimensions tuple encoded by its encoder.
+    Only for additive metrics, which are collapsed by SummingMergeTree anyway.
+    `buffer_limit` limits number of distinct dimensions tuples, `bytes_limit` is
+    not applied as rows are encoded on flush
+    """
+
+    by_rows = True
+    aggregating = True
+
+    def __init__(self, discovery, **kwargs):
+        super().__init__(**kwargs)
+        self.discovery = discovery
+        metrics = discovery.get_metrics()
+        self.metrics = [(name, to_float if type_name(ctype).startswith('Float') else to_int)
+                        for name, ctype in metrics.items()]
+        self.dimensions = [name for name in discovery.columns if name not in metrics]
+        self.rows = {}
+        self.pushed = 0
+
+    def add(self, doc):
+        """
+        Adds row (dict or JSON string) to row with the same dimensions
+        """
+        if isinstance(doc, str):
+            doc = ujson.loads(doc)
+        key = tuple([doc.get(name) for name in self.dimensions])
+        try:
+            row = self.rows.get(key)
+        except TypeError:
+            # not hashable values like arrays
+            key = ujson.dumps(key)
+            row = self.rows.get(key)
+        if row is None:
+            if not self.counter:
+                self.created = monotonic()
+            row = self.rows[key] = dict(doc)
+            for name, convert in self.metrics:
+                row[name] = convert(row.get(name))
+            self.counter += 1
+            if self.counter >= self.buffer_limit:
+                self.full = True
+        else:
+            for name, convert in self.metrics:
+                row[name] += convert(doc.get(name))
+        self.pushed += 1
+
+    def append(self, rec):
+        self.add(rec)
+
+    def append_many(self, recs):
+        for rec in recs:
+            self.add(rec)
+
+    def prepare(self):
+        if self.rows:
+            encode = self.discovery.encoder
+            rows, self.rows = self.rows, {}
+            self.write('\n'.join([encode(row) for row in rows.values()] + ['']).encode(), count=0)
+        super().prepare()
+
+
+class PartitionedBuffer:
+    """
+    Keeps separate buffer for every partition: month of `date_field`, as `toYYYYMM`
+    partition key of `TableDiscovery.merge_tree()`. Every buffer is inserted by
+    separate request, so every insert creates single part.
+    Limits and flush policy are applied to every partition buffer.
+
+    factory: function creating buffer of partition
+    encoder: function row -> JSON string, ujson by default
+    date_type: type of `date_field`, month of `DateTime` values is taken in UTC
+    """
+
+    by_rows = True
+    aggregating = False
+    partitioned = True
+
+    def __init__(self, date_field, factory, encoder=None, date_type=None):
+        self.date_field = date_field
+        self.timestamps = date_type is not None and type_name(date_type).startswith('DateTime')
+        self.factory = factory
+        self.encoder = encoder
+        self.parts = {}
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts.values())
+
+    def partition(self, doc):
+        """
+        Partition of row as `toYYYYMM(date_field)`
+        """
+        value = doc.get(self.date_field)
+        if value is None or value == '':
+            raise ValueError(f'Row has no {self.date_field} to choose partition')
+        if self.timestamps:
+            if isinstance(value, str) and value.isdigit():
+                value = int(value)
+            days = to_timestamp(value) // 86400
+        else:
+            days = to_days(value)
+        date = datetime.date.fromordinal(EPOCH_ORDINAL + days)
+        return date.year * 100 + date.month
+
+    def add(self, doc):
+        if isinstance(doc, str):
+            doc = ujson.loads(doc)
+        key = self.partition(doc)
+        part = self.parts.get(key)
+        if part is None:
+            part = self.parts[key] = self.factory()
+        if part.by_rows:
+            part.add(doc)
+        else:
+            part.append(self.encoder(doc) if self.encoder else ujson.dumps(doc, ensure_ascii=False))
+
+    def append(self, rec):
+        self.add(rec)
+
+    def append_many(self, recs):
+        for rec in recs:
+            self.add(rec)
+
+    def write(self, data, count=1):
+        """
+        Append already encoded rows
+        """
+        for line in data.decode().splitlines():
+            if line:
+                self.add(line)
+
+    def due(self, now=None):
+        return any(part.due(now) for part in self.parts.values())
+
+    def pop_parts(self, due_only=False, now=None):
+        """
+        Removes and returns not empty buffers of partitions (only due ones if `due_only`)
+        """
+        keys = [key for key, part in self.parts.items() if len(part) and (not due_only or part.due(now))]
+        return [self.parts.pop(key) for key in keys]
+
+    def close(self):
+        for part in self.parts.values():
+            part.close()
+
+
+class BufferMap(dict):
+    """
+    Dict table -> Buffer, that creates missing buffers using `factory(table)`
+    """
+
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+
+    def __missing__(self, table):
+        buff = self[table] = self.factory(table)
+        return buff
+
+
 class WriterContext:
-    def __init__(self, ch, table, dump_json=True, ensure_ascii=False, buffer_limit=5000):
+    """
+    format: insert format, `JSONEachRow` or `RowBinary`
+    columns: dict column name -> type or TableDiscovery. Required for `RowBinary`,
+        for `JSONEachRow` rows are encoded by compiled encoder of these columns
+    compression: compression of insert body, see `Buffer`
+    bytes_limit: flush when buffer reaches this size in bytes
+    backend: buffer storage, `memory` or `file`, see `Buffer`
+    """
+
+    def __init__(self, ch, table, dump_json=True, ensure_ascii=False, buffer_limit=5000, format='JSONEachRow', columns=None, compression=None, bytes_limit=None,
+                 backend=BACKEND_MEMORY, directory=None):
         self.ch = ch
+        self.backend = backend
+        self.directory = directory
+        self.compression = compression
+        self.bytes_limit = bytes_limit
         self.ensure_ascii = ensure_ascii
         self.dump_json = dump_json
         self.buffer_limit = buffer_limit
         self.table = table
+        self.format = format
+        self.encoder = None
+        self.json_encoder = None
+        if format == ROWBINARY:
+            self.encoder = RowBinaryEncoder(columns)
+        elif columns:
+            # TableDiscovery caches compiled encoder
+            self.json_encoder = getattr(columns, 'encoder', None) or compile_json_encoder(columns)
         self.set_buffer()
 
     def flush(self):
@@ -38,20 +314,56 @@ class WriterContext:
         return self.ch._flush(self.table, buff)
 
     def set_buffer(self):
-        self.buffer = Buffer(buffer_limit=self.buffer_limit)
+        self.buffer = Buffer(
+            buffer_limit=self.buffer_limit,
+            bytes_limit=self.bytes_limit,
+            format=self.format,
+            columns=self.encoder.names if self.encoder else None,
+            compression=self.compression,
+            backend=self.backend,
+            directory=self.directory)
 
     def push(self, *docs):
         try:
             for doc in docs:
-                if self.dump_json == True:
-                    doc = ujson.dumps(doc, self.ensure_ascii)
-                self.buffer.append(doc)
+                if self.encoder:
+                    self.buffer.write(self.encoder.encode(doc))
+                else:
+                    if self.json_encoder:
+                        doc = self.json_encoder(doc)
+                    elif self.dump_json == True:
+                        doc = ujson.dumps(doc, self.ensure_ascii)
+                    self.buffer.append(doc)
                 if self.buffer.full:
                     self.flush()
         except Exception as e:
             logger.exception('exc during push')
             raise e
 
+    def push_many(self, docs):
+        """
+        Serializes list of documents in one pass and writes it as one chunk
+        """
+        docs = list(docs)
+        pos = 0
+        while pos < len(docs):
+            end = pos + self.buffer.capacity
+            chunk = docs[pos:end]
+            if self.encoder:
+                self.buffer.write(self.encoder.encode_many(chunk), count=len(chunk))
+            else:
+                if self.json_encoder:
+                    encode = self.json_encoder
+                    chunk = [encode(doc) for doc in chunk]
+                elif self.dump_json == True:
+                    dumps = ujson.dumps
+                    ensure_ascii = self.ensure_ascii
+                    chunk = [dumps(doc, ensure_ascii) for doc in chunk]
+                self.buffer.append_many(chunk)
+            if self.buffer.full:
+                self.flush()
+            pos = end
+
     def __enter__(self):
         return self
 
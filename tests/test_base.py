@@ -6,8 +6,19 @@ from time import sleep
 from itertools import count
 from simplech import TableDiscovery, ClickHouse, DeltaGenerator, AsyncClickHouse
 from simplech.mock import HttpClientMock, AsyncHttpClientMock, create_factory
+from simplech.pool import ConnectionPool
+from simplech.retry import RetryPolicy, ClickHouseHTTPError
+from simplech.balancer import HostBalancer, parse_hosts
+from simplech.write_context import Buffer
+from simplech.types import DateTime
+from simplech.compression import DecompressingReader
+import zlib
+import gzip
+import io
 import datetime
 import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 set1 = [
     {'date': '2018-12-31', 'ga_channelGrouping': 'Organic Search', 'ga_dateHourMinute': '201812311517', 'ga_dimension2': '128983921.1546258642', 'ga_fullReferrer': 'google', 'ga_newUsers': '1', 'ga_pageviews': '1', 'ga_sessionCount': '1',
@@ -155,3 +166,470 @@ def test_ch_context_manager():
     with ch.table('test1') as b:
         b.push({'name': 'lalala'})
 
+
+
+def test_connection_pool():
+
+    created = []
+
+    class Conn:
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    def factory():
+        created.append(Conn())
+        return created[-1]
+
+    pool = ConnectionPool(factory, maxsize=2, idle_timeout=60, timeout=0.1)
+    c1, reused = pool.acquire()
+    assert not reused
+    pool.release(c1)
+    c2, reused = pool.acquire()
+    assert reused and c2 is c1
+    c3, _ = pool.acquire()
+    with pytest.raises(TimeoutError):
+        pool.acquire()
+    pool.discard(c3)
+    assert c3.closed
+    pool.release(c2)
+    pool.idle_timeout = 0
+    sleep(0.01)
+    c4, reused = pool.acquire()
+    assert not reused and c1.closed
+    assert len(created) == 3
+    pool.close()
+
+
+async def async_ch_shared_session():
+
+    async with AsyncClickHouse() as ch:
+        ch.conn_class = create_factory(async_mode=True)
+        await ch.run('CREATE TABLE IF NOT EXISTS test1 (name String) ENGINE = Log()')
+        session = ch._session
+        ch.push('textxx', {'name': 'lalala'})
+        await ch.flush('textxx')
+        await ch.select('SELECT * FROM textxx')
+        assert ch._session is session
+    assert session.closed
+    assert ch._session is None
+
+
+def test_async_ch_shared_session():
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(async_ch_shared_session())
+
+
+def test_compressed_buffer():
+
+    rows = [ujson.dumps({'name': 'lalala', 'value': i}) for i in range(100)]
+    for method, wbits in (('gzip', 31), ('deflate', 15)):
+        buff = Buffer(compression=method)
+        for row in rows:
+            buff.append(row)
+        buff.prepare()
+        assert buff.headers == {'Content-Encoding': method}
+        payload = buff.buffer.read()
+        assert zlib.decompress(payload, wbits) == ('\n'.join(rows) + '\n').encode()
+        assert len(payload) < buff.size
+    assert Buffer().headers == {}
+
+
+def test_ch_push_compressed():
+
+    ch = ClickHouse(compression='gzip')
+    ch.conn_class = create_factory()
+    conn, _ = ch._pool.acquire()
+    ch._pool.release(conn)
+
+    ch.push('textxx', {'name': 'lalala'})
+    ch.push('textxx', {'name': 'nananan'})
+    ch.flush('textxx')
+    assert conn.last_headers == {'Content-Encoding': 'gzip'}
+    recs = [*ch.objects_stream('SELECT * FROM textxx')]
+    assert recs == [{'name': 'lalala'}, {'name': 'nananan'}]
+
+
+def test_decompressing_reader():
+
+    lines = [ujson.dumps({'name': 'lalala', 'value': i}).encode() + b'\n' for i in range(1000)]
+    payload = gzip.compress(b''.join(lines))
+    reader = DecompressingReader(io.BytesIO(payload), 'gzip', chunk_size=100)
+    assert [reader.readline() for _ in lines] == lines
+    assert reader.readline() == b''
+    reader = DecompressingReader(io.BytesIO(payload), 'gzip', chunk_size=100)
+    assert reader.read(5) == lines[0][:5]
+    assert reader.read() == b''.join(lines)[5:]
+
+    ch = ClickHouse(response_compression=True)
+    assert ch._build_params('SELECT 1')['enable_http_compression'] == 1
+    with pytest.raises(ValueError):
+        ClickHouse(response_compression='xz')
+
+
+def test_buffer_flush_policy():
+
+    buff = Buffer(buffer_limit=100, bytes_limit=30, max_age=0.05)
+    assert not buff.due()
+    buff.append('{"name": "lalala"}')
+    assert not buff.full and not buff.due()
+    sleep(0.06)
+    assert buff.due()
+    buff.append('{"name": "bababa"}')
+    assert buff.full
+
+
+def test_ch_flush_due():
+
+    ch = ClickHouse(buffer_limit=2)
+    ch.conn_class = create_factory()
+    ch.configure_buffer('aged', max_age=0.05)
+    ch.configure_buffer('small', bytes_limit=10)
+    with pytest.raises(TypeError):
+        ch.configure_buffer('small', unknown=1)
+
+    ch.push('aged', {'name': 'lalala'})
+    ch.push('fresh', {'name': 'lalala'})
+    assert len(ch._buffer['aged']) == 1
+    sleep(0.06)
+    ch.flush_due()
+    assert len(ch._buffer['aged']) == 0
+    assert len(ch._buffer['fresh']) == 1
+
+    ch.push('fresh', {'name': 'bababa'})
+    assert len(ch._buffer['fresh']) == 0
+    ch.push('small', {'name': 'lalala'})
+    assert len(ch._buffer['small']) == 0
+
+
+def test_ch_flush_thread():
+
+    ch = ClickHouse(flush_thread=True, flush_interval=0.02, flush_every=0.05, buffer_limit=2)
+    ch.conn_class = create_factory()
+    flushed = []
+    threads = set()
+
+    def _flush(table, buff):
+        threads.add(threading.current_thread())
+        flushed.append((table, len(buff)))
+    ch._flush = _flush
+
+    ch.push('textxx', {'name': 'lalala'})
+    ch.push('textxx', {'name': 'bababa'})
+    sleep(0.1)
+    assert flushed == [('textxx', 2)]
+    # full buffer is flushed by background thread, not by producer
+    assert threads == {ch._flusher}
+    ch.push('textxx', {'name': 'nanana'})
+    sleep(0.1)
+    assert flushed == [('textxx', 2), ('textxx', 1)]
+    ch.push('other', {'name': 'lalala'})
+    ch.close()
+    assert not ch._flusher.is_alive()
+    assert flushed[-1] == ('other', 1)
+
+
+async def async_ch_inflight_limits():
+
+    ch = AsyncClickHouse(max_inflight=1)
+    active = []
+    sent = []
+
+    async def insert(sql_query, body, headers=None, retry=None):
+        active.append(1)
+        assert len(active) == 1
+        await asyncio.sleep(0.02)
+        sent.append(body.read())
+        active.pop()
+    ch._insert = insert
+
+    for i in range(3):
+        ch.push('textxx', {'name': i})
+        ch.flush('textxx')
+    assert ch.pending_bytes > 0
+    await ch.drain()
+    assert len(ch._waiting) == 0
+    await asyncio.gather(*ch._batches)
+    assert len(sent) == 3 and ch.pending_bytes == 0
+
+    ch.max_pending_bytes = 30
+    ch.overflow = 'drop_oldest'
+    ch.configure_buffer('textxx', backend='file')
+    flushes = []
+    for i in range(3):
+        ch.push('textxx', {'name': i})
+        flushes.append(ch.flush('textxx'))
+    # no batch started yet, the oldest one dropped in favor of the last one
+    assert flushes[0].done() is False and ch.pending_bytes <= 30
+    assert await flushes[0] is None
+    await ch.close()
+    assert sent[3:] == [b'{"name":1}\n', b'{"name":2}\n']
+    assert ch.pending_bytes == 0 and not ch._dropped
+
+
+async def async_ch_spill(tmp_path):
+
+    ch = AsyncClickHouse(max_pending_bytes=10, overflow='spill', spool_dir=str(tmp_path / 'spool'),
+                         buffer_backend='file', buffer_dir=str(tmp_path))
+    ch.push('textxx', {'name': 'spilled'})
+    buff = ch._buffer['textxx']
+    await ch.flush('textxx')
+    assert len(ch._spool) == 1 and buff.buffer.closed
+    await ch.close()
+
+
+def test_async_ch_spill(tmp_path):
+
+    with pytest.raises(ValueError):
+        AsyncClickHouse(overflow='spill')
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(async_ch_spill(tmp_path))
+
+
+def test_async_ch_inflight_limits():
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(async_ch_inflight_limits())
+
+
+def test_ch_retry_and_spool(tmp_path):
+
+    ch = ClickHouse(retry=RetryPolicy(attempts=3, backoff=0.001), spool_dir=str(tmp_path), replay_interval=3600)
+    ch.conn_class = create_factory()
+    send = ch._send
+    failures = [2]
+
+    def flaky_send(method, url, body=None, headers=None, hosts=None):
+        if failures[0]:
+            failures[0] -= 1
+            raise ConnectionRefusedError()
+        return send(method, url, body=body, headers=headers, hosts=hosts)
+    ch._send = flaky_send
+
+    ch.push('textxx', {'name': 'retried'})
+    ch.flush('textxx')
+    assert failures == [0]
+    conn, _ = ch._pool.acquire()
+    ch._pool.release(conn)
+    assert conn.mock_store.buff.getvalue() == b'{"name":"retried"}\n'
+
+    failures[0] = 100
+    ch.push('textxx', {'name': 'spilled'})
+    ch.flush('textxx')
+    assert len(ch._spool) == 1
+    # server is down, batch stays in spool
+    assert ch.replay_spool() == 0 and len(ch._spool) == 1
+
+    failures[0] = 0
+    assert ch.replay_spool() == 1 and len(ch._spool) == 0
+    assert conn.mock_store.buff.getvalue().endswith(b'{"name":"spilled"}\n')
+
+    # server errors are retried, rejected batch is raised at once and not spooled
+    statuses = []
+
+    def error_send(method, url, body=None, headers=None, hosts=None):
+        pool, conn, response = send(method, url, body=body, headers=headers, hosts=hosts)
+        response.status = statuses.pop(0) if statuses else 200
+        return pool, conn, response
+    ch._send = error_send
+    statuses[:] = [503]
+    ch.push('textxx', {'name': 'unavailable'})
+    ch.flush('textxx')
+    assert not statuses and len(ch._spool) == 0
+    statuses[:] = [400, 400]
+    ch.push('textxx', {'name': 'bad'})
+    with pytest.raises(ClickHouseHTTPError):
+        ch.flush('textxx')
+    assert statuses == [400] and len(ch._spool) == 0
+    ch.close()
+
+
+def test_file_buffer(tmp_path):
+
+    buff = Buffer(backend='file', directory=str(tmp_path), compression='gzip')
+    buff.append('{"name":"lalala"}')
+    buff.prepare()
+    assert zlib.decompress(buff.buffer.read(), 47) == b'{"name":"lalala"}\n'
+    buff.close()
+    with pytest.raises(ValueError):
+        Buffer(backend='mmap')
+
+    ch = ClickHouse()
+    ch.conn_class = create_factory()
+    ch.configure_buffer('textxx', backend='file', directory=str(tmp_path))
+    ch.push('textxx', {'name': 'lalala'})
+    buff = ch._buffer['textxx']
+    assert buff.backend == 'file'
+    ch.flush('textxx')
+    assert buff.buffer.closed
+    conn, _ = ch._pool.acquire()
+    ch._pool.release(conn)
+    assert conn.mock_store.buff.getvalue() == b'{"name":"lalala"}\n'
+    ch.close()
+
+
+def test_aggregating_buffer():
+
+    ch = ClickHouse()
+    ch.conn_class = create_factory()
+    td = ch.discover('stat', columns={'date': 'Date', 'name': 'String', 'hits': 'Int64', 'spent': 'Float64'})\
+        .metrics('hits', 'spent').aggregate(buffer_limit=3)
+    for i in range(10):
+        td.push({'date': '2019-01-01', 'name': str(i % 2), 'hits': '1', 'spent': 0.5})
+    ch.push('stat', '{"date": "2019-01-01", "name": "0", "hits": 2}', jsonDump=False)
+    buff = ch._buffer['stat']
+    assert buff.aggregating and len(buff) == 2 and buff.pushed == 11
+    ch.flush('stat')
+    conn, _ = ch._pool.acquire()
+    ch._pool.release(conn)
+    rows = [json.loads(line) for line in conn.mock_store.buff.getvalue().splitlines()]
+    assert rows == [{'date': '2019-01-01', 'name': '0', 'hits': 7, 'spent': 2.5},
+                    {'date': '2019-01-01', 'name': '1', 'hits': 5, 'spent': 2.5}]
+
+    # flushed when number of keys reaches limit
+    td.push_many({'name': str(i), 'hits': 1} for i in range(3))
+    assert not len(ch._buffer['stat'])
+    ch.configure_buffer('stat', aggregate=None)
+    assert 'stat' not in ch._row_tables
+    ch.close()
+
+
+def test_partitioned_buffer():
+
+    ch = ClickHouse()
+    ch.conn_class = create_factory()
+    sent = []
+
+    def insert(sql_query, body, headers=None, retry=None):
+        sent.append([json.loads(line) for line in body.read().decode().splitlines()])
+    ch._insert = insert
+
+    td = ch.discover('events', columns={'date': 'Date', 'name': 'String', 'hits': 'Int64'})
+    with pytest.raises(ValueError):
+        td.by_partition()
+    td.date('date').by_partition(buffer_limit=3)
+    td.push_many({'date': f'2019-0{i % 2 + 1}-10', 'name': str(i), 'hits': '1'} for i in range(5))
+    # january partition is full and written alone
+    assert sent == [[{'date': '2019-01-10', 'name': str(i), 'hits': 1} for i in (0, 2, 4)]]
+    assert len(ch._buffer['events']) == 2
+
+    ch.push('events', {'date': datetime.date(2019, 3, 1), 'name': 'x'})
+    ch.flush('events')
+    assert [[row['date'][:7] for row in rows] for rows in sent[1:]] == [['2019-02', '2019-02'], ['2019-03']]
+    assert not len(ch._buffer['events'])
+    with pytest.raises(ValueError):
+        td.push({'name': 'no date'})
+
+    # DateTime partition key, unix timestamps accepted
+    td = ch.discover('visits', columns={'dt': 'DateTime', 'name': 'String'})\
+        .set(dt=DateTime, set_main=True).by_partition()
+    td.push_many([{'dt': 1547107222}, {'dt': '2019-01-31 23:59:59'}, {'dt': datetime.datetime(2019, 2, 1)}])
+    assert sorted(ch._buffer['visits'].parts) == [201901, 201902]
+    assert len(ch._buffer['visits'].parts[201901]) == 2
+    ch.close()
+
+
+def test_host_balancer():
+
+    assert parse_hosts('ch1,ch2:8124, [::1]:9000') == ['ch1:8123', 'ch2:8124', '[::1]:9000']
+    assert parse_hosts(['ch1'], 8443) == ['ch1:8443']
+
+    balancer = HostBalancer(['a:1', 'b:1', 'c:1'], strategy='round_robin')
+    a, b, c = balancer.hosts
+    assert [balancer.candidates()[0] for _ in range(4)] == [a, b, c, a]
+    balancer.mark_down(b)
+    assert balancer.candidates()[-1] is b
+    assert b not in [balancer.candidates()[0] for _ in range(4)]
+    balancer.report(b, 0.1)
+    assert b.down_until == 0
+
+    balancer = HostBalancer(['a:1', 'b:1', 'c:1'])
+    a, b, c = balancer.hosts
+    balancer.report(a, 1)
+    balancer.report(b, 0.01)
+    balancer.report(c, 0.1)
+    # slow host loses to its neighbour
+    assert a not in [balancer.candidates()[0] for _ in range(6)]
+
+
+def test_ch_multiple_hosts():
+
+    ch = ClickHouse(dsn='http://default@ch1:8123,ch2:8124/stats')
+    ch.conn_class = create_factory()
+    assert ch.db == 'stats' and ch.base_url == 'ch1:8123'
+    assert set(ch._pools) == {'ch1:8123', 'ch2:8124'}
+    assert ch.check_hosts() == {'ch1:8123': True, 'ch2:8124': True}
+    ch.close()
+
+
+def test_ch_push_many():
+
+    ch = ClickHouse(buffer_limit=3)
+    ch.conn_class = create_factory()
+    ch.push_many('textxx', [{'name': i} for i in range(5)])
+    # first chunk of 3 rows flushed when buffer became full
+    conn, _ = ch._pool.acquire()
+    ch._pool.release(conn)
+    assert conn.mock_store.buff.getvalue() == b'{"name":0}\n{"name":1}\n{"name":2}\n'
+    assert len(ch._buffer['textxx']) == 2
+    ch.push_many('textxx', ['{"name":5}'], jsonDump=False)
+    ch.flush_all()
+    assert conn.mock_store.buff.getvalue() == b'{"name":3}\n{"name":4}\n{"name":5}\n'
+
+    with ch.table('textyy', buffer_limit=4) as b:
+        b.push_many({'name': i} for i in range(6))
+        assert len(b.buffer) == 2
+    assert len(b.buffer) == 0
+    ch.close()
+
+
+def test_ch_serialize_executor():
+
+    executor = ThreadPoolExecutor(4)
+    ch = ClickHouse(buffer_limit=1000, serialize_executor=executor)
+    ch.conn_class = create_factory()
+    ch.push_many('textxx', [{'name': i} for i in range(50)])
+    ch.push('textxx', {'name': 50})
+    ch.push_many('textxx', [{'name': i} for i in range(51, 100)])
+    ch.flush('textxx')
+    conn, _ = ch._pool.acquire()
+    ch._pool.release(conn)
+    assert conn.mock_store.buff.getvalue() == b''.join(b'{"name":%d}\n' % i for i in range(100))
+
+    # executor is busy, encoded rows wait for serialized ones
+    executor.submit(sleep, 0.05)
+    ch.push_many('textxx', [{'name': 1}, {'name': 2}])
+    ch.push_many('textxx', ['{"name":3}'], jsonDump=False)
+    ch.discover('textxx', columns={'name': 'Int64'}).push_many([{'name': 4}])
+    ch.flush('textxx')
+    assert conn.mock_store.buff.getvalue().startswith(b''.join(b'{"name":%d}\n' % i for i in range(1, 5)))
+    ch.close()
+    executor.shutdown()
+
+
+async def async_ch_serialize_executor():
+
+    executor = ThreadPoolExecutor(4)
+    ch = AsyncClickHouse(buffer_limit=10, serialize_executor=executor)
+    sent = []
+
+    async def insert(sql_query, body, headers=None, retry=None):
+        sent.append(body.read())
+    ch._insert = insert
+
+    ch.push_many('textxx', [{'name': i} for i in range(25)])
+    ch.push('textxx', {'name': 25})
+    await ch.flush_all()
+    await asyncio.gather(*ch._batches)
+    assert b''.join(sent) == b''.join(b'{"name":%d}\n' % i for i in range(26))
+    assert [chunk.count(b'\n') for chunk in sent] == [10, 10, 6]
+    await ch.close()
+    executor.shutdown()
+
+
+def test_async_ch_serialize_executor():
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(async_ch_serialize_executor())
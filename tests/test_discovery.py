@@ -1,14 +1,19 @@
 import json
 import ujson
 import os
+import io
 import pytest
 from time import sleep
 from itertools import count
 from simplech import TableDiscovery, ClickHouse, DeltaGenerator, AsyncClickHouse
-from simplech.discovery import cast_string
+from simplech.discovery import cast_string, Guesstimator
+from simplech.helpers import cast_strings
+from simplech.deltagen import partition_ranges
+from simplech.sharding import tuple_hasher
 from simplech.mock import create_factory
 from simplech.helpers import max_type
 import datetime
+import decimal
 import asyncio
 from collections import Counter
 from simplech.types import *
@@ -67,6 +72,12 @@ def test_string_detection():
     assert cast_string('2018-12-22') == Date
     assert cast_string('2018-12-22 18:33:44') == DateTime
     assert cast_string('sdfsdf 2018-12-22 18:33:44') == String
+    assert cast_string('2018/12/22') == Date
+    assert cast_string('2018-12-22 00:00:00') == Date
+    assert cast_string('2018-12-22T18:33:44.123+03:00') == DateTime
+    assert cast_string('2018-02-30') == String
+    assert cast_string('2018-12-22 25:33:44') == String
+    assert cast_strings(['1', '1', 'x']) == [Int64, Int64, String]
 
 
 def test_wrap_sync():
@@ -199,6 +210,218 @@ def test_td_context_manager_async():
     loop.run_until_complete(td_context_manager_async())
 
 
+def test_td_encoder():
+
+    ch = ClickHouse()
+    ch.conn_class = create_factory()
+    td = ch.discover('textxx', columns={'name': 'String', 'num': 'Int64', 'date': 'Date', 'dt': 'DateTime', 'price': 'Float64'})
+    encode = td.encoder
+    assert td.encoder is encode
+    row = {'name': 12, 'num': '3', 'date': datetime.date(2019, 1, 10), 'dt': datetime.datetime(2019, 1, 10, 8, 0, 22),
+           'price': decimal.Decimal('1.25'), 'unknown': {'x': 1}}
+    assert json.loads(encode(row)) == {
+        'name': '12', 'num': 3, 'date': '2019-01-10', 'dt': '2019-01-10 08:00:22', 'price': 1.25}
+    assert list(json.loads(encode({}))) == ['name', 'num', 'date', 'dt', 'price']
+
+    td.set('uid', UInt64)
+    assert td.encoder is not encode
+    td.push(row)
+    td.push_many([row])
+    ch.flush_all()
+    conn, _ = ch._pool.acquire()
+    ch._pool.release(conn)
+    assert [json.loads(line)['uid'] for line in conn.mock_store.buff.getvalue().splitlines()] == [0, 0]
+
+
+def test_delta_modes():
+
+    ch = ClickHouse()
+    ch.conn_class = create_factory()
+    td = ch.discover('deals', columns={'date': 'Date', 'name': 'String', 'uid': 'Int64', 'sale': 'Int64'})\
+        .date('date').metrics('sale')
+    # stored rows, returned by mock for any select
+    ch.push_many('deals', [
+        {'date': '2019-01-10', 'name': 'a', 'uid': '2', 'sale': '5'},
+        {'date': '2019-01-10', 'name': 'b', 'uid': '1', 'sale': '3'},
+        {'date': '2019-01-11', 'name': 'a', 'uid': '10', 'sale': '7'}])
+    ch.flush_all()
+    new = [
+        {'date': '2019-01-10', 'name': 'a', 'uid': 2, 'sale': 6},
+        {'date': '2019-01-11', 'name': 'a', 'uid': 9, 'sale': 1},
+        {'date': '2019-01-11', 'name': 'a', 'uid': 10, 'sale': 7}]
+
+    with td.difference('2019-01-10', '2019-01-11', new, mode='sorted') as delta:
+        rows = list(delta)
+    assert rows == [
+        {'date': '2019-01-10', 'name': 'a', 'uid': 2, 'sale': 1},
+        {'date': '2019-01-10', 'name': 'b', 'uid': '1', 'sale': -3},
+        {'date': '2019-01-11', 'name': 'a', 'uid': 9, 'sale': 1}]
+    assert delta.stat == {'update': 1, 'remove': 1, 'create': 1, 'unchanged': 1}
+    with pytest.raises(ValueError):
+        list(DeltaGenerator(td, ch, '2019-01-10', '2019-01-11', new[::-1], mode='sorted'))
+
+    conn, _ = ch._pool.acquire()
+    ch._pool.release(conn)
+    conn.mock_store.buff = io.BytesIO(b'{"date":"2019-01-10","name":"b","uid":"1","sale":"-3","__delta":"remove"}\n')
+    with td.difference('2019-01-10', '2019-01-11', new, mode='server') as delta:
+        assert list(delta) == [{'date': '2019-01-10', 'name': 'b', 'uid': '1', 'sale': '-3'}]
+    assert delta.stat['remove'] == 1
+    conn, _ = ch._pool.acquire()
+    ch._pool.release(conn)
+    assert 'full outer join' in conn.last_query and conn.last_method == 'post'
+    assert conn.last_params['delta_new_structure'] == '`date` Date, `name` String, `uid` Int64, `sale` Int64'
+    assert b'{"date":"2019-01-11","name":"a","uid":9,"sale":1}' in conn.last_body
+
+    with pytest.raises(ValueError):
+        td.difference('2019-01-10', '2019-01-11', new, mode='unknown').__enter__()
+
+
+async def delta_sorted_async():
+    ch = AsyncClickHouse()
+    ch.conn_class = create_factory(async_mode=True)
+    td = ch.discover('ga_stat', set3).date('date').metrics('sale')
+    ch.push_many('ga_stat', set3)
+    await ch.flush_all()
+    new = sorted(set3[1:], key=lambda row: (row['cid'], row['date']))
+    async with td.difference('2019-01-10', '2019-01-13', new, mode='sorted') as delta:
+        rows = [row async for row in delta]
+    assert rows == [{**set3[0], 'sale': -10000}]
+    assert delta.stat == {'update': 0, 'remove': 1, 'create': 0, 'unchanged': 2}
+
+
+def test_delta_sorted_async():
+    loop.run_until_complete(delta_sorted_async())
+
+
+def test_delta_hash_keys():
+
+    ch = ClickHouse()
+    ch.conn_class = create_factory()
+    td = ch.discover('ga_stat', set3).date('date').metrics('sale')
+    hasher = tuple_hasher(td.get_dimensions())
+    conn, _ = ch._pool.acquire()
+    ch._pool.release(conn)
+    conn.mock_store.buff = io.BytesIO(ujson.dumps({'__key': str(hasher(set3[0])), 'sale': '1'}).encode() + b'\n')
+    with td.difference('2019-01-10', '2019-01-13', set3, hash_keys=True) as delta:
+        rows = list(delta)
+    assert rows == [{**set3[0], 'sale': 9999}] + set3[1:]
+    assert delta.stat == {'update': 1, 'remove': 0, 'create': 2, 'unchanged': 0}
+    conn, _ = ch._pool.acquire()
+    ch._pool.release(conn)
+    assert conn.last_query.startswith('select cityhash64(')
+    with pytest.raises(ValueError):
+        DeltaGenerator(td, ch, '2019-01-10', '2019-01-13', set3, mode='sorted', hash_keys=True)
+
+
+def test_delta_apply():
+
+    ch = ClickHouse(buffer_limit=2)
+    ch.conn_class = create_factory()
+    td = ch.discover('ga_stat', set3).date('date').metrics('sale')
+    inserts = []
+    ch._insert = lambda sql_query, body, headers=None: inserts.append(body.read().splitlines())
+    with td.difference('2019-01-10', '2019-01-13', set3) as delta:
+        assert delta.apply(batch_size=1)['create'] == 3
+    assert [len(rows) for rows in inserts] == [2, 1]
+    assert sorted(json.loads(row)['sale'] for rows in inserts for row in rows) == [4000, 10000, 70000]
+
+
+def test_delta_apply_partitioned():
+
+    ch = ClickHouse()
+    ch.conn_class = create_factory()
+    td = ch.discover('stat', columns={'date': 'Date', 'name': 'String', 'hits': 'Int64'})\
+        .date('date').metrics('hits').by_partition(buffer_limit=2)
+    data = [{'date': f'2019-0{i % 2 + 1}-10', 'name': str(i), 'hits': 1} for i in range(5)]
+    inserts = []
+    ch._insert = lambda sql_query, body, headers=None: inserts.append(
+        [json.loads(row)['date'][:7] for row in body.read().splitlines()])
+    with td.difference('2019-01-01', '2019-02-28', data) as delta:
+        assert delta.apply(batch_size=1)['create'] == 5
+    # every insert targets single month
+    assert sorted(inserts) == [['2019-01'], ['2019-01', '2019-01'], ['2019-02', '2019-02']]
+
+
+async def delta_apply_async():
+    ch = AsyncClickHouse()
+    ch.conn_class = create_factory(async_mode=True)
+    td = ch.discover('ga_stat', set3).date('date').metrics('sale')
+    async with td.difference('2019-01-09', '2019-01-13', set3, partition='day') as delta:
+        stat = await delta.apply_async(batch_size=2)
+    assert stat['create'] == 3 and not len(ch._buffer['ga_stat'])
+
+
+def test_delta_apply_async():
+    loop.run_until_complete(delta_apply_async())
+
+
+def test_delta_partitioned():
+
+    assert partition_ranges('2019-01-30', datetime.date(2019, 3, 2)) == [
+        ('2019-01-30', '2019-01-31'), ('2019-02-01', '2019-02-28'), ('2019-03-01', '2019-03-02')]
+    assert len(partition_ranges('2019-01-30', '2019-02-02', 'day')) == 4
+
+    ch = ClickHouse()
+    ch.conn_class = create_factory()
+    td = ch.discover('ga_stat', set3).date('date').metrics('sale')
+    with td.difference('2019-01-01', '2019-02-10', set3, partition='day', concurrency=2) as delta:
+        rows = list(delta)
+    assert len(delta.generators) == 41
+    assert sorted(rows, key=lambda row: row['cid']) == set3
+    assert delta.stat == {'update': 0, 'remove': 0, 'create': 3, 'unchanged': 0}
+    with pytest.raises(ValueError):
+        with td.difference('2019-02-01', '2019-02-10', set3, partition='month') as delta:
+            list(delta)
+
+
+async def delta_partitioned_async():
+    ch = AsyncClickHouse()
+    ch.conn_class = create_factory(async_mode=True)
+    td = ch.discover('ga_stat', set3).date('date').metrics('sale')
+    async with td.difference('2019-01-01', '2019-02-10', set3, partition='month') as delta:
+        rows = [row async for row in delta]
+    assert len(rows) == 3 and delta.stat['create'] == 3
+
+
+def test_delta_partitioned_async():
+    loop.run_until_complete(delta_partitioned_async())
+
+
+def test_guesstimator():
+
+    ch = ClickHouse()
+    td = ch.discover('ga_stat', (rec for rec in set3 * 1000), limit=10)
+    assert td.stat['used_rows'] == 10
+    assert td.columns['sale'] == Int64 and td.columns['date'] == Date and td.columns['date_time'] == DateTime
+    assert ch.discover('ga_stat', set3[0]).columns['sale'] == Int64
+    assert Guesstimator().update([]).result() == {}
+
+    guess = Guesstimator(limit=None)
+    guess.update({'n': str(i), 'name': 'x'} for i in range(1000))
+    # shapes are cached, strings are not inferred after first value
+    assert len(guess._shapes) == 3 and 'name' in guess._done
+    guess.update([{'n': 'text', 'none': None}])
+    assert guess.result() == {'n': String, 'name': String}
+
+    rows = [{'n': 1}] * 1000 + [{'n': 1.5}]
+    assert Guesstimator(limit=100).update(rows).result() == {'n': Int64}
+    assert Guesstimator(limit=100, sample=True, seed=1).update(rows * 10).result()['n'] in (Int64, Float64)
+    assert Guesstimator(limit=None, stable_after=10).update(rows).result() == {'n': Int64}
+
+    # strings are cast by batches of column values
+    guess = Guesstimator(limit=None, batch_size=4).update({'d': f'2019-01-1{i}', 'n': i} for i in range(6))
+    assert guess._pending['d'] == ['2019-01-14', '2019-01-15']
+    assert guess.result() == {'d': Date, 'n': Int64} and not guess._pending
+
+    # columns keep order of input
+    rows = [{'name': 'a', 'n': 1, 'date': '2019-01-01'}, {'name': 'b', 'n': 2, 'date': '2019-01-02'}]
+    assert list(TableDiscovery('t', records=rows).columns) == ['name', 'n', 'date']
+
+    # invalid date does not hide valid dates of the same shape
+    rows = [{'a': '0000-00-00', 'b': '2019-01-10'}, {'a': '2018-02-30', 'b': '2019-02-10'}]
+    assert TableDiscovery('t', records=rows).columns == {'a': String, 'b': Date}
+
+
 def test_final_type():
 
     assert max_type(Counter(['String', 'DateTime'])) == 'String'
@@ -0,0 +1,145 @@
+import struct
+import asyncio
+import datetime
+import pytest
+from simplech import ClickHouse, AsyncClickHouse
+from simplech.mock import create_factory
+from simplech.rowbinary import RowBinaryEncoder, RowBinaryDecoder, leb128, to_days, to_timestamp
+from simplech.types import *
+
+
+def test_leb128():
+
+    assert leb128(0) == b'\x00'
+    assert leb128(127) == b'\x7f'
+    assert leb128(128) == b'\x80\x01'
+    assert leb128(300) == b'\xac\x02'
+
+
+def test_dates_conversion():
+
+    assert to_days('1970-01-02') == 1
+    assert to_days(datetime.date(2019, 1, 10)) == 17906
+    assert to_days(datetime.datetime(2019, 1, 10, 23, 59)) == 17906
+    assert to_timestamp('2019-01-10 08:00:22') == 1547107222
+    assert to_timestamp(datetime.datetime(2019, 1, 10, 8, 0, 22)) == 1547107222
+    assert to_timestamp(datetime.datetime(2019, 1, 10, 11, 0, 22, tzinfo=datetime.timezone(datetime.timedelta(hours=3)))) == 1547107222
+    assert to_timestamp('2019-01-10') == 1547078400
+
+
+def test_rowbinary_encoder():
+
+    enc = RowBinaryEncoder({'id': UInt32, 'name': 'String', 'value': float, 'date': Date})
+    data = enc.encode({'id': 7, 'name': 'яя', 'date': '1970-01-02', 'extra': 1})
+    assert data == struct.pack('<I', 7) + b'\x04' + 'яя'.encode() + struct.pack('<d', 0) + struct.pack('<H', 1)
+    assert enc.encode_many([{'id': 1}, {'id': 2}]) == enc.encode({'id': 1}) + enc.encode({'id': 2})
+    with pytest.raises(TypeError):
+        RowBinaryEncoder({'arr': 'Array(String)'})
+
+
+def test_ch_table_rowbinary():
+
+    ch = ClickHouse()
+    ch.conn_class = create_factory()
+    conn, _ = ch._pool.acquire()
+    ch._pool.release(conn)
+
+    columns = {'id': UInt64, 'name': String}
+    with ch.table('test1', format='RowBinary', columns=columns) as w:
+        w.push({'id': 1, 'name': 'lalala'}, {'id': 2, 'name': 'bababa'})
+
+    assert conn.last_query == 'insert into test1 (`id`, `name`) format rowbinary'
+    enc = RowBinaryEncoder(columns)
+    assert conn.read() == enc.encode({'id': 1, 'name': 'lalala'}) + enc.encode({'id': 2, 'name': 'bababa'})
+
+
+def binary_result():
+    header = b'\x04' + b''.join(leb128(len(n)) + n for n in [b'id', b'name', b'date', b'value'])
+    header += b''.join(leb128(len(t)) + t for t in [b'UInt64', b'LowCardinality(String)', b'Date', b'Nullable(Float64)'])
+    rows = struct.pack('<Q', 1) + b'\x06lalala' + struct.pack('<H', 17906) + b'\x00' + struct.pack('<d', 1.5)
+    rows += struct.pack('<Q', 2) + b'\x00' + struct.pack('<H', 0) + b'\x01'
+    return header + rows
+
+
+def test_rowbinary_decoder_chunks():
+
+    data = binary_result()
+    for size in (1, 3, len(data)):
+        decoder = RowBinaryDecoder()
+        rows = []
+        for i in range(0, len(data), size):
+            rows.extend(decoder.feed(data[i:i + size]))
+        decoder.close()
+        assert decoder.names == ['id', 'name', 'date', 'value']
+        assert rows == [(1, 'lalala', datetime.date(2019, 1, 10), 1.5), (2, '', datetime.date(1970, 1, 1), None)]
+
+    decoder = RowBinaryDecoder(columns={'id': UInt32, 'date': DateTime}, as_dict=True)
+    assert decoder.feed(struct.pack('<II', 5, 1547107222) + b'\x01') == [
+        {'id': 5, 'date': datetime.datetime(2019, 1, 10, 8, 0, 22)}]
+    with pytest.raises(ValueError):
+        decoder.close()
+
+
+def test_ch_rows_stream():
+
+    ch = ClickHouse()
+    ch.conn_class = create_factory()
+    conn, _ = ch._pool.acquire()
+    ch._pool.release(conn)
+    conn.mock_store.buff.write(binary_result())
+
+    rows = [*ch.rows_stream('SELECT * FROM test1', as_dict=True)]
+    assert conn.last_query == 'select * from test1 format rowbinarywithnamesandtypes'
+    assert rows[0] == {'id': 1, 'name': 'lalala', 'date': datetime.date(2019, 1, 10), 'value': 1.5}
+    assert len(rows) == 2
+
+
+async def async_ch_rows_stream():
+
+    ch = AsyncClickHouse()
+    ch.conn_class = create_factory(async_mode=True)
+    ch._get_session().mock_store.buff.write(binary_result())
+    rows = []
+    async for row in ch.rows_stream('SELECT * FROM test1'):
+        rows.append(row)
+    assert rows[1] == (2, '', datetime.date(1970, 1, 1), None)
+    await ch.close()
+
+
+def test_async_ch_rows_stream():
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(async_ch_rows_stream())
+
+
+def test_ch_select_columns():
+
+    np = pytest.importorskip('numpy')
+    ch = ClickHouse()
+    ch.conn_class = create_factory()
+    conn, _ = ch._pool.acquire()
+    ch._pool.release(conn)
+    conn.mock_store.buff.write(binary_result())
+
+    cols = ch.select_columns('SELECT * FROM test1')
+    assert list(cols['id']) == [1, 2]
+    assert cols['id'].dtype == np.uint64
+    assert list(cols['name']) == ['lalala', '']
+    assert cols['date'][0] == np.datetime64('2019-01-10')
+    assert list(cols['value']) == [1.5, None]
+
+
+def test_columnar_decoder_fixed():
+
+    np = pytest.importorskip('numpy')
+    from simplech.columns import ColumnarDecoder
+
+    decoder = ColumnarDecoder(columns={'id': UInt32, 'dt': DateTime, 'v': Float32})
+    data = b''.join(struct.pack('<IIf', i, 1547107222 + i, i / 2) for i in range(3000))
+    for i in range(0, len(data), 1000):
+        decoder.feed(data[i:i + 1000])
+    cols = decoder.result()
+    assert len(cols['id']) == 3000
+    assert cols['id'][2999] == 2999
+    assert cols['dt'][1] == np.datetime64('2019-01-10T08:00:23')
+    assert cols['v'].dtype == np.float32
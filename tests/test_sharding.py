@@ -0,0 +1,89 @@
+import asyncio
+import pytest
+from collections import Counter
+from simplech import ClickHouse, AsyncClickHouse
+from simplech.mock import create_factory
+from simplech.cityhash import city_hash64, int_hash64
+from simplech.sharding import shard_slots, city_hash, tuple_hasher
+
+
+def test_city_hash64():
+
+    assert city_hash64(b'') == 11160318154034397263
+    assert city_hash64(b'hello') == 2578220239953316063
+    assert city_hash64(b'simple-clickhouse') == 15474975085356244226
+    assert city_hash64(b'x' * 40) == 3896669899269749907
+    assert city_hash64(bytes(range(200))) == 16473298439844927062
+    assert city_hash('hello') == city_hash64(b'hello')
+    assert city_hash(1) == int_hash64(1) == 10577349846663553072
+    assert city_hash('a', 1) != city_hash(1, 'a')
+
+
+def test_tuple_hasher():
+
+    hasher = tuple_hasher({'name': 'String', 'num': 'Int32', 'date': 'Date', 'dt': 'DateTime'})
+    assert hasher.expression == 'cityHash64(`name`, `num`, `date`, toString(`dt`))'
+    row = {'name': 'a', 'num': '-5', 'date': '2019-01-10', 'dt': '2019-01-10 08:00:22'}
+    # computed by ClickHouse
+    assert hasher(row) == 2720701143921327151
+
+
+def test_shard_slots():
+
+    assert shard_slots([1, 2, 1]) == [0, 1, 1, 2]
+
+
+def test_ch_sharded():
+
+    ch = ClickHouse()
+    ch.conn_class = create_factory()
+    router = ch.sharded('events_local', 'uid', hash=None, shards=[
+        'ch1,ch1-replica', {'hosts': ['ch2:8124'], 'weight': 2}])
+    assert [shard.hosts for shard in router.shards] == [['ch1:8123', 'ch1-replica:8123'], ['ch2:8124']]
+
+    # uid % 3: 0 -> first shard, 1 and 2 -> second one
+    assert [router.shard_index({'uid': uid}) for uid in range(6)] == [0, 1, 1, 0, 1, 1]
+    with router:
+        for uid in range(6):
+            router.push({'uid': uid})
+        assert [len(client._buffer['events_local']) for client in router.clients] == [2, 4]
+    assert all(not len(client._buffer['events_local']) for client in router.clients)
+
+    router = ch.sharded('events_local', ('uid', 'name'), shards=['ch1', 'ch2', 'ch3'])
+    spread = Counter(router.shard_index({'uid': uid, 'name': 'x'}) for uid in range(300))
+    assert set(spread) == {0, 1, 2}
+    router.close()
+
+    # values are hashed as values of column types
+    td = ch.discover('events_local', columns={'uid': 'UInt64', 'num': 'Int32', 'name': 'String'})
+    router = ch.sharded('events_local', ('uid', 'num'), shards=['ch1', 'ch2', 'ch3'], columns=td)
+    assert router._key({'uid': '123', 'num': -5}) == router._key({'uid': 123, 'num': '-5'}) \
+        == tuple_hasher({'uid': 'UInt64', 'num': 'Int32'})({'uid': 123, 'num': -5})
+    assert city_hash(123, -5) != router._key({'uid': 123, 'num': -5})
+    router.close()
+    with pytest.raises(ValueError):
+        ch.sharded('events_local', 'site', shards=['ch1'], columns={'uid': 'UInt64'})
+    # DateTime is hashed as UInt32 value
+    router = ch.sharded('events_local', 'dt', shards=['ch1', 'ch2'], columns={'dt': 'DateTime'})
+    assert router._key({'dt': '2019-01-10 08:00:22'}) == router._key({'dt': 1547107222}) == int_hash64(1547107222)
+    router.close()
+    with pytest.raises(ValueError):
+        ch.sharded('events_local', 'id', shards=['ch1'], columns={'id': 'UUID'})
+
+
+async def async_ch_sharded():
+
+    ch = AsyncClickHouse()
+    ch.conn_class = create_factory(async_mode=True)
+    async with ch.sharded('events_local', 'uid', shards=['ch1', 'ch2']) as router:
+        for uid in range(10):
+            router.push({'uid': uid})
+        await router.flush()
+        assert all(not len(client._buffer['events_local']) for client in router.clients)
+    await ch.close()
+
+
+def test_async_ch_sharded():
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(async_ch_sharded())